@@ -0,0 +1,68 @@
+import argparse
+import logging
+import os
+import sqlite3
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from utils import time_it
+
+ANNOTATION_TABLE = 'annotations'
+
+
+@time_it(message="build annotation store: {store_path}")
+def build_annotation_store(annotation_path: str, store_path: str, chunksize: int = 500_000) -> None:
+    """Convert the annotation TSV into an SQLite store indexed on protein_id.
+
+    Duplicate protein IDs keep their first row, like drop_duplicates in main. The store is written next to
+    its final path and moved into place at the end, so an interrupted build never leaves a partial store.
+    """
+    tmp_path = f'{store_path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    with sqlite3.connect(tmp_path) as conn:
+        for chunk in pd.read_csv(annotation_path, sep='\t', chunksize=chunksize):
+            chunk.to_sql(ANNOTATION_TABLE, conn, if_exists='append', index=False)
+
+        duplicates = conn.execute(
+            f"DELETE FROM {ANNOTATION_TABLE} WHERE rowid NOT IN "
+            f"(SELECT MIN(rowid) FROM {ANNOTATION_TABLE} GROUP BY protein_id)").rowcount
+        if duplicates:
+            logging.info(f"Removed {duplicates} rows with duplicate protein IDs.")
+        conn.execute(f"CREATE UNIQUE INDEX idx_{ANNOTATION_TABLE}_protein_id ON {ANNOTATION_TABLE} (protein_id)")
+
+    os.replace(tmp_path, store_path)
+    logging.info(f"Annotation store saved to {store_path}")
+
+
+@time_it(message="fetch annotations")
+def fetch_annotations(store_path: str, protein_ids: Iterable[str]) -> pd.DataFrame:
+    """Return the annotation rows of the given protein IDs, as read from the deduplicated annotation TSV.
+
+    IDs missing from the store are left out.
+    """
+    if not os.path.exists(store_path):
+        raise FileNotFoundError(f"Annotation store {store_path} does not exist; build it with annotation_store.py")
+
+    with sqlite3.connect(store_path) as conn:
+        conn.execute("CREATE TEMP TABLE leaves (protein_id TEXT PRIMARY KEY)")
+        conn.executemany("INSERT OR IGNORE INTO leaves VALUES (?)", ((protein_id,) for protein_id in protein_ids))
+        annotations = pd.read_sql_query(
+            f"SELECT a.* FROM {ANNOTATION_TABLE} AS a JOIN leaves USING (protein_id)", conn)
+
+    # SQLite NULLs come back as None; use NaN for missing values as read_csv does
+    annotations = annotations.where(annotations.notna(), np.nan)
+    return annotations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the SQLite annotation store from the annotation table.")
+    parser.add_argument("--annotations", required=True, help="Path to the annotation TSV with a protein_id column.")
+    parser.add_argument("--store", required=True, help="Path to the SQLite store to create.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s\t%(levelname)s\t%(message)s')
+    build_annotation_store(args.annotations, args.store)
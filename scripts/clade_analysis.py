@@ -1,76 +1,192 @@
 import logging
 import os
-from typing import Dict, List, Any
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 from ete3 import Tree
 
+from compact_tree import CompactTree
+from taxonomy_codes import MISSING, TAXONOMY_FEATURES
 from utils import time_it
 
 
-def count_clade_proteins(node: Tree) -> Dict[str, Any]:
-    """Count Crassvirales, bacterial, and viral proteins, and calculate their ratios by specific bacterial phyla."""
-    total_proteins = 0
-    crassvirales_proteins = 0
-    bacterial_proteins = 0
-    viral_proteins = 0
-    other_proteins = 0
-
-    # Initialize counts and lists for specific bacterial phyla
-    phyla_counts: Dict[str, int] = {
-        'Bacteroidetes': 0,
-        'Actinobacteria': 0,
-        'Bacillota': 0,
-        'Proteobacteria': 0,
-        'Other': 0
-    }
-    phyla_protein_names: Dict[str, List[str]] = {
-        'Bacteroidetes': [],
-        'Actinobacteria': [],
-        'Bacillota': [],
-        'Proteobacteria': [],
-        'Other': []
-    }
-
-    crassvirales_protein_names = []
-    bacterial_protein_names = []
-    viral_protein_names = []
-    other_protein_names = []
-    all_protein_names = []
-
-    for leaf in node.iter_leaves():
-        total_proteins += 1
-        all_protein_names.append(leaf.name)
-
-        if 'order' in leaf.features and leaf.order == 'Crassvirales':
-            crassvirales_proteins += 1
-            crassvirales_protein_names.append(leaf.name)
-        elif 'superkingdom' in leaf.features and leaf.superkingdom == 'Bacteria':
-            bacterial_proteins += 1
-            bacterial_protein_names.append(leaf.name)
-
-            # Count by specific phyla
-            if leaf.phylum in ['Bacteroidetes', 'Bacteroidota']:
-                phyla_counts['Bacteroidetes'] += 1
-                phyla_protein_names['Bacteroidetes'].append(leaf.name)
-            elif leaf.phylum in ['Actinobacteria', 'Actinomycetota']:
-                phyla_counts['Actinobacteria'] += 1
-                phyla_protein_names['Actinobacteria'].append(leaf.name)
-            elif leaf.phylum in ['Bacillota', 'Firmicutes']:
-                phyla_counts['Bacillota'] += 1
-                phyla_protein_names['Bacillota'].append(leaf.name)
-            elif leaf.phylum in ['Proteobacteria', 'Pseudomonadota']:
-                phyla_counts['Proteobacteria'] += 1
-                phyla_protein_names['Proteobacteria'].append(leaf.name)
-            else:
-                phyla_counts['Other'] += 1
-                phyla_protein_names['Other'].append(leaf.name)
-        elif 'superkingdom' in leaf.features and leaf.superkingdom == 'Viruses':
-            viral_proteins += 1
-            viral_protein_names.append(leaf.name)
+# Phylum spellings grouped into the bacterial buckets reported for every clade
+PHYLA_GROUPS: Dict[str, List[str]] = {
+    'Bacteroidetes': ['Bacteroidetes', 'Bacteroidota'],
+    'Actinobacteria': ['Actinobacteria', 'Actinomycetota'],
+    'Bacillota': ['Bacillota', 'Firmicutes'],
+    'Proteobacteria': ['Proteobacteria', 'Pseudomonadota'],
+    'Other': []
+}
+
+# Keys of the per-clade counters: protein categories, bacterial phyla and the clade size
+CLADE_COUNT_KEYS: List[str] = ['crassvirales', 'bacterial', 'viral', 'other', *PHYLA_GROUPS, 'total']
+
+# Columns of the clade tables (all_clades.tsv and the selected clade tables)
+CLADE_TABLE_COLUMNS: List[str] = [
+    'clade_name', 'node_name', 'cluster_name',
+    'number_of_crassvirales', 'number_of_bacterial', 'number_of_viral', 'number_of_other', 'number_of_members',
+    'crassvirales_ratio',
+    'crassvirales_proteins', 'bacterial_proteins', 'viral_proteins', 'other_proteins',
+    'ratio_crass_to_bacterial', 'ratio_crass_to_viral',
+    'ratio_viral_to_bacterial', 'ratio_bacterial_to_viral',
+    'ratio_bacterial_to_total', 'ratio_viral_to_total', 'ratio_other_to_total',
+    'all_members',
+    'number_of_Bacteroidetes', 'Bacteroidetes_protein_names',
+    'ratio_Bacteroidetes_to_bacterial', 'ratio_Bacteroidetes_to_total',
+    'number_of_Actinobacteria', 'Actinobacteria_protein_names',
+    'ratio_Actinobacteria_to_bacterial', 'ratio_Actinobacteria_to_total',
+    'number_of_Bacillota', 'Bacillota_protein_names',
+    'ratio_Bacillota_to_bacterial', 'ratio_Bacillota_to_total',
+    'number_of_Proteobacteria', 'Proteobacteria_protein_names',
+    'ratio_Proteobacteria_to_bacterial', 'ratio_Proteobacteria_to_total',
+    'number_of_Other_bacteria', 'Other_bacteria_protein_names',
+    'ratio_Other_to_bacterial', 'ratio_Other_to_total',
+    'preorder_start', 'preorder_end'
+]
+
+# Comma-joined protein name columns of the clade tables, by counter key
+MEMBER_NAME_COLUMNS: Dict[str, str] = {
+    'crassvirales': 'crassvirales_proteins',
+    'bacterial': 'bacterial_proteins',
+    'viral': 'viral_proteins',
+    'other': 'other_proteins',
+    'total': 'all_members',
+    'Bacteroidetes': 'Bacteroidetes_protein_names',
+    'Actinobacteria': 'Actinobacteria_protein_names',
+    'Bacillota': 'Bacillota_protein_names',
+    'Proteobacteria': 'Proteobacteria_protein_names',
+    'Other': 'Other_bacteria_protein_names'
+}
+
+# Columns of the leaf table written alongside compact clade tables
+LEAF_TABLE_COLUMNS: List[str] = ['preorder_index', 'protein_id', 'category', 'phylum_group']
+
+# Columns of the selection profile bounding the thresholds at which a clade is selected
+SELECTION_PROFILE_COLUMNS: List[str] = ['selected_above', 'selected_up_to']
+
+
+def threshold_grid(start: float = 0, stop: float = 100, step: float = 10) -> List[float]:
+    """Return the Crassvirales ratio thresholds (%) from start to stop inclusive, whole numbers as ints."""
+    if step <= 0 or start > stop:
+        raise ValueError(f"Invalid thresholds start {start}, stop {stop}, step {step}: expected step > 0 and "
+                         f"start <= stop")
+    thresholds: List[float] = []
+    for i in range(int(round((stop - start) / step)) + 1):
+        threshold = round(start + i * step, 10)
+        thresholds.append(int(threshold) if float(threshold).is_integer() else threshold)
+    return thresholds
+
+
+DEFAULT_THRESHOLDS: List[float] = threshold_grid()
+
+
+def classify_taxonomy(superkingdom: Optional[str], phylum: Optional[str], order: Optional[str]) -> List[str]:
+    """Return the counter keys a protein contributes to (its category, its phylum bucket if bacterial, and total).
+
+    Missing annotation fields are passed as None.
+    """
+    if order == 'Crassvirales':
+        return ['crassvirales', 'total']
+    if superkingdom == 'Bacteria':
+        for phylum_group, phylum_names in PHYLA_GROUPS.items():
+            if phylum in phylum_names:
+                return ['bacterial', phylum_group, 'total']
+        return ['bacterial', 'Other', 'total']
+    if superkingdom == 'Viruses':
+        return ['viral', 'total']
+    return ['other', 'total']
+
+
+def classify_leaf(leaf: Tree) -> List[str]:
+    """Return the counter keys an annotated ete3 leaf contributes to."""
+    return classify_taxonomy(*(getattr(leaf, feature) if feature in leaf.features else None
+                               for feature in ('superkingdom', 'phylum', 'order')))
+
+
+def classify_compact_leaves(tree: CompactTree) -> Tuple[np.ndarray, np.ndarray, List[List[str]]]:
+    """Classify the leaves of a compact tree by their taxonomy codes.
+
+    Returns the leaf indices, and for each leaf an index into the returned list of counter key lists; each
+    distinct (superkingdom, phylum, order) code combination is classified only once.
+    """
+    leaves = tree.leaf_indices
+    columns = [TAXONOMY_FEATURES.index(feature) for feature in ('superkingdom', 'phylum', 'order')]
+    combinations, inverse = np.unique(tree.taxonomy[np.ix_(leaves, columns)], axis=0, return_inverse=True)
+    keys = []
+    for codes in combinations.tolist():
+        if codes[0] == MISSING:
+            keys.append(classify_taxonomy(None, None, None))
         else:
-            other_proteins += 1
-            other_protein_names.append(leaf.name)
+            keys.append(classify_taxonomy(*(tree.vocabulary.values[column][code]
+                                            for column, code in zip(columns, codes))))
+    return leaves, inverse.reshape(-1), keys
+
+
+def leaf_count_matrix(tree: CompactTree) -> np.ndarray:
+    """Return a (nodes x CLADE_COUNT_KEYS) indicator matrix with one row per leaf set to the keys it counts towards."""
+    leaves, inverse, keys = classify_compact_leaves(tree)
+    key_matrix = np.zeros((len(keys), len(CLADE_COUNT_KEYS)), dtype=np.int32)
+    for row, leaf_keys in enumerate(keys):
+        key_matrix[row, [CLADE_COUNT_KEYS.index(key) for key in leaf_keys]] = 1
+    matrix = np.zeros((len(tree), len(CLADE_COUNT_KEYS)), dtype=np.int32)
+    matrix[leaves] = key_matrix[inverse]
+    return matrix
+
+
+class BipartitionCounts:
+    """Leaf counts on both sides of every edge of a base tree, shared by all rootings of that tree.
+
+    An edge splits the leaves into the same two sets however the tree is rooted. For the base tree, the
+    side below node ``v``'s edge holds ``counts[v]`` leaves per CLADE_COUNT_KEYS entry and the other side
+    ``counts[0] - counts[v]``. The clade counts of a tree rerooted from the base with set_outgroup are read
+    off these sides instead of being summed again.
+    """
+
+    def __init__(self, base: CompactTree) -> None:
+        self.base = base
+        self.leaf_counts = leaf_count_matrix(base)
+        self.counts = base.subtree_sums(self.leaf_counts)
+
+    def clade_counts(self, tree: CompactTree) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the leaf indicator matrix and the per-clade counts of the base tree or one rerooting of it."""
+        if tree is self.base:
+            return self.leaf_counts, self.counts
+        if tree.origin is None or len(tree) < 2:
+            raise ValueError("Tree was not rerooted from the base tree with set_outgroup")
+
+        # The outgroup is the first child of the new root. Its strict ancestors in the base tree now face
+        # away from the root on the other side of the edge to their child on the path (toward_outgroup);
+        # every other node keeps its base subtree. The node set_outgroup adds (origin -1) groups the
+        # remaining children of the old root, i.e. it is the far side of the path's topmost edge, like node 0.
+        toward_outgroup = np.full(len(self.base), -1, dtype=np.int64)
+        node = int(tree.origin[1])
+        parent = self.base.parent.tolist()
+        while node > 0:
+            toward_outgroup[parent[node]] = node
+            node = parent[node]
+
+        origin = np.maximum(tree.origin, 0)
+        path_child = toward_outgroup[origin]
+        on_path = path_child >= 0
+        counts = self.counts[origin]
+        counts[on_path] = self.counts[0] - self.counts[path_child[on_path]]
+        counts[0] = self.counts[0]
+
+        leaf_counts = self.leaf_counts[origin]
+        leaf_counts[tree.origin < 0] = 0
+        return leaf_counts, counts
+
+
+def build_clade_info(counts: Dict[str, int], names: Dict[str, str]) -> Dict[str, Any]:
+    """Turn per-clade counters and joined protein names into clade statistics and ratios."""
+    crassvirales_proteins = counts['crassvirales']
+    bacterial_proteins = counts['bacterial']
+    viral_proteins = counts['viral']
+    other_proteins = counts['other']
+    total_proteins = counts['total']
+    phyla_counts = {phylum: counts[phylum] for phylum in PHYLA_GROUPS}
 
     # Calculate ratios
     ratio_crass_to_bacterial = crassvirales_proteins / bacterial_proteins if bacterial_proteins > 0 else 0
@@ -82,19 +198,6 @@ def count_clade_proteins(node: Tree) -> Dict[str, Any]:
     ratio_other_to_total = other_proteins / total_proteins if total_proteins > 0 else 0
     ratio_crass_to_total = crassvirales_proteins / total_proteins if total_proteins > 0 else 0
 
-    # # Add the ratio_crass_to_total to the node's features
-    # node.add_features(ratio_crass_to_total=ratio_crass_to_total)
-
-    # node.add_features(
-    #     ratio_crass_to_total=clade_info["ratio_crass_to_total"],
-    #     total_proteins=clade_info["total_proteins"]
-    # )
-
-    node.add_features(
-        ratio_crass_to_total=ratio_crass_to_total,
-        total_proteins=total_proteins
-    )
-
     # Calculate ratios for specific bacterial phyla
     phyla_ratios = {}
     for phylum in phyla_counts:
@@ -109,11 +212,11 @@ def count_clade_proteins(node: Tree) -> Dict[str, Any]:
         "viral_proteins": viral_proteins,
         "other_proteins": other_proteins,
         "total_proteins": total_proteins,
-        "crassvirales_protein_names": ', '.join(crassvirales_protein_names),
-        "bacterial_protein_names": ', '.join(bacterial_protein_names),
-        "viral_protein_names": ', '.join(viral_protein_names),
-        "other_protein_names": ', '.join(other_protein_names),
-        "all_protein_names": ', '.join(all_protein_names),
+        "crassvirales_protein_names": names['crassvirales'],
+        "bacterial_protein_names": names['bacterial'],
+        "viral_protein_names": names['viral'],
+        "other_protein_names": names['other'],
+        "all_protein_names": names['total'],
         "ratio_crass_to_bacterial": ratio_crass_to_bacterial,
         "ratio_crass_to_viral": ratio_crass_to_viral,
         "ratio_viral_to_bacterial": ratio_viral_to_bacterial,
@@ -123,21 +226,85 @@ def count_clade_proteins(node: Tree) -> Dict[str, Any]:
         "ratio_other_to_total": ratio_other_to_total,
         "ratio_crass_to_total": ratio_crass_to_total,  # Include this in the returned dictionary for other uses
         **{f'{phylum}_proteins': phyla_counts[phylum] for phylum in phyla_counts},
-        **{f'{phylum}_protein_names': ', '.join(phyla_protein_names[phylum]) for phylum in phyla_counts},
+        **{f'{phylum}_protein_names': names[phylum] for phylum in phyla_counts},
         **phyla_ratios
     }
 
 
+def count_clade_proteins(node: Tree) -> Dict[str, Any]:
+    """Count Crassvirales, bacterial, and viral proteins, and calculate their ratios by specific bacterial phyla."""
+    counts = {key: 0 for key in CLADE_COUNT_KEYS}
+    protein_names: Dict[str, List[str]] = {key: [] for key in CLADE_COUNT_KEYS}
+
+    for leaf in node.iter_leaves():
+        for key in classify_leaf(leaf):
+            counts[key] += 1
+            protein_names[key].append(leaf.name)
+
+    names = {key: ', '.join(protein_names[key]) for key in CLADE_COUNT_KEYS}
+    clade_info = build_clade_info(counts, names)
+
+    node.add_features(
+        ratio_crass_to_total=clade_info['ratio_crass_to_total'],
+        total_proteins=clade_info['total_proteins']
+    )
+
+    return clade_info
+
+
+def iter_clade_info(tree: CompactTree, with_names: bool = True,
+                    bipartitions: Optional[BipartitionCounts] = None) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Yield clade statistics for every node of a compact tree in postorder.
+
+    All per-clade counts are computed at once as prefix sums over the preorder ranges, or taken from
+    ``bipartitions`` if the tree is a rooting of its base tree, and each protein name column is a slice of
+    the leaves carrying that key (left empty when ``with_names`` is False). The Crassvirales ratio and clade
+    size are stored in ``tree.features`` for the tree plot.
+    """
+    if bipartitions is not None:
+        leaf_counts, counts = bipartitions.clade_counts(tree)
+    else:
+        leaf_counts = leaf_count_matrix(tree)
+        counts = tree.subtree_sums(leaf_counts)
+    prefix = np.cumsum(leaf_counts, axis=0) - leaf_counts  # leaves preceding each node in preorder, per key
+    end_prefix = prefix + counts
+
+    key_names = [[tree.names[node] for node in np.flatnonzero(leaf_counts[:, k]).tolist()]
+                 for k in range(len(CLADE_COUNT_KEYS))]
+
+    total = counts[:, CLADE_COUNT_KEYS.index('total')]
+    crassvirales = counts[:, CLADE_COUNT_KEYS.index('crassvirales')]
+    tree.features['ratio_crass_to_total'] = np.divide(crassvirales, total, out=np.zeros(len(tree)),
+                                                      where=total > 0).tolist()
+    tree.features['total_proteins'] = total.tolist()
+
+    counts_list, prefix_list, end_prefix_list = counts.tolist(), prefix.tolist(), end_prefix.tolist()
+    for node in tree.postorder():
+        node_counts = dict(zip(CLADE_COUNT_KEYS, counts_list[node]))
+        if with_names:
+            names = {key: ', '.join(key_names[k][prefix_list[node][k]:end_prefix_list[node][k]])
+                     for k, key in enumerate(CLADE_COUNT_KEYS)}
+        else:
+            names = dict.fromkeys(CLADE_COUNT_KEYS, '')
+        yield node, build_clade_info(node_counts, names)
+
+
 # @time_it("Save clade statistics")
-def save_clade_statistics(tree: Tree, cluster_name: str, output_file: str) -> None:
-    """Save statistics for all nodes to a file."""
+def build_clade_statistics(tree: CompactTree, cluster_name: str, compact: bool = False,
+                           bipartitions: Optional[BipartitionCounts] = None) -> pd.DataFrame:
+    """Return the statistics of all clades with more than one protein.
+
+    With ``compact``, the table leaves out the comma-joined member name columns; membership then follows
+    from the preorder intervals and the leaf table written by save_leaf_table. Pass the ``bipartitions`` of
+    the base tree to reuse its counts when building the tables of several rootings of it.
+    """
     results = []
-    for node in tree.traverse("postorder"):
-        clade_info = count_clade_proteins(node)
+    for node, clade_info in iter_clade_info(tree, with_names=not compact, bipartitions=bipartitions):
         if clade_info["total_proteins"] > 1:
+            node_name = tree.names[node]
             ratio = round((clade_info["crassvirales_proteins"] / clade_info["total_proteins"]) * 100, 2)
             results.append([
-                f"Clade_{node.name}", node.name, cluster_name,
+                f"Clade_{node_name}", node_name, cluster_name,
                 clade_info["crassvirales_proteins"], clade_info["bacterial_proteins"], clade_info["viral_proteins"],
                 clade_info["other_proteins"], clade_info["total_proteins"], ratio,
                 clade_info["crassvirales_protein_names"], clade_info["bacterial_protein_names"],
@@ -165,112 +332,208 @@ def save_clade_statistics(tree: Tree, cluster_name: str, output_file: str) -> No
                 clade_info["Other_proteins"], clade_info["Other_protein_names"],
                 round(clade_info["ratio_Other_to_bacterial"], 2),
                 round(clade_info["ratio_Other_to_total"], 2),
+                node, int(tree.subtree_end[node]),
             ])
-    df = pd.DataFrame(results, columns=[
-        'clade_name', 'node_name', 'cluster_name',
-        'number_of_crassvirales', 'number_of_bacterial', 'number_of_viral', 'number_of_other', 'number_of_members',
-        'crassvirales_ratio',
-        'crassvirales_proteins', 'bacterial_proteins', 'viral_proteins', 'other_proteins',
-        'ratio_crass_to_bacterial', 'ratio_crass_to_viral',
-        'ratio_viral_to_bacterial', 'ratio_bacterial_to_viral',
-        'ratio_bacterial_to_total', 'ratio_viral_to_total', 'ratio_other_to_total',
-        'all_members',
-        'number_of_Bacteroidetes', 'Bacteroidetes_protein_names',
-        'ratio_Bacteroidetes_to_bacterial', 'ratio_Bacteroidetes_to_total',
-        'number_of_Actinobacteria', 'Actinobacteria_protein_names',
-        'ratio_Actinobacteria_to_bacterial', 'ratio_Actinobacteria_to_total',
-        'number_of_Bacillota', 'Bacillota_protein_names',
-        'ratio_Bacillota_to_bacterial', 'ratio_Bacillota_to_total',
-        'number_of_Proteobacteria', 'Proteobacteria_protein_names',
-        'ratio_Proteobacteria_to_bacterial', 'ratio_Proteobacteria_to_total',
-        'number_of_Other_bacteria', 'Other_bacteria_protein_names',
-        'ratio_Other_to_bacterial', 'ratio_Other_to_total'
-    ])
+    df = pd.DataFrame(results, columns=CLADE_TABLE_COLUMNS)
+    if compact:
+        df = df.drop(columns=list(MEMBER_NAME_COLUMNS.values()))
+    return df
+
+
+def save_clade_statistics(tree: CompactTree, cluster_name: str, output_file: str,
+                          compact: bool = False, bipartitions: Optional[BipartitionCounts] = None) -> pd.DataFrame:
+    """Save statistics for all nodes to a file and return them (see build_clade_statistics)."""
+    df = build_clade_statistics(tree, cluster_name, compact, bipartitions)
     df.to_csv(output_file, sep='\t', index=False)
+    return df
 
 
-def find_largest_non_intersecting_clades(df: pd.DataFrame, threshold: float) -> pd.DataFrame:
-    """Find the largest non-intersecting clades with Crassvirales ratio above the threshold."""
-    # Convert crassvirales_ratio to float
+def build_leaf_table(tree: CompactTree) -> pd.DataFrame:
+    """Return the leaves with their preorder index, protein category and bacterial phylum group."""
+    leaves, inverse, keys = classify_compact_leaves(tree)
+    rows = []
+    for node, key_index in zip(leaves.tolist(), inverse.tolist()):
+        leaf_keys = keys[key_index]
+        rows.append([node, tree.names[node], leaf_keys[0], leaf_keys[1] if leaf_keys[0] == 'bacterial' else ''])
+    return pd.DataFrame(rows, columns=LEAF_TABLE_COLUMNS)
+
+
+def save_leaf_table(tree: CompactTree, output_file: str) -> pd.DataFrame:
+    """Save the leaf table of a compact clade table and return it."""
+    leaves = build_leaf_table(tree)
+    leaves.to_csv(output_file, sep='\t', index=False)
+    return leaves
+
+
+def load_leaf_table(leaves_file: str) -> pd.DataFrame:
+    """Load a leaf table saved by save_leaf_table."""
+    return pd.read_csv(leaves_file, sep='\t', dtype={'protein_id': str, 'category': str, 'phylum_group': str},
+                       keep_default_na=False)
+
+
+def add_member_columns(df: pd.DataFrame, leaves: pd.DataFrame) -> pd.DataFrame:
+    """Add the comma-joined member name columns to a compact clade table, using the leaves within each interval."""
+    df = df.copy()
+    leaves = leaves.sort_values('preorder_index')
+    starts = df['preorder_start'].to_numpy()
+    ends = df['preorder_end'].to_numpy()
+
+    for key, column in MEMBER_NAME_COLUMNS.items():
+        if key == 'total':
+            key_leaves = leaves
+        else:
+            key_leaves = leaves[(leaves['category'] == key) | (leaves['phylum_group'] == key)]
+        positions = key_leaves['preorder_index'].to_numpy()
+        names = key_leaves['protein_id'].tolist()
+        first = np.searchsorted(positions, starts).tolist()
+        last = np.searchsorted(positions, ends).tolist()
+        df[column] = [', '.join(names[i:j]) for i, j in zip(first, last)]
+
+    ordered_columns = [column for column in CLADE_TABLE_COLUMNS if column in df.columns]
+    return df[ordered_columns + [column for column in df.columns if column not in ordered_columns]]
+
+
+def selection_bounds(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """Return, per clade row, the Crassvirales ratio range over which it is a largest non-intersecting clade.
+
+    Rows must already be in selection order, i.e. sorted by number_of_members descending. Clades are taken
+    in that order and a clade is kept if its ratio reaches the threshold and no kept clade
+    intersects it. Clades are subtrees, so they intersect only when their preorder intervals are nested,
+    and the first qualifying clade on every root-to-leaf path is kept. A clade is therefore selected at
+    threshold t exactly when ``lower < t <= upper``, where ``upper`` is its own ratio and ``lower`` the
+    highest ratio among the larger clades containing it. Nested clades of equal size (unary nodes) share
+    members and ratio, and only the first of them in the row order can be selected. Both bounds come
+    from one preorder sweep with a stack of open intervals; rows that can never be selected get
+    ``lower = upper = -inf``.
+    """
+    ratios = pd.to_numeric(df['crassvirales_ratio'], errors='coerce').fillna(-np.inf).to_numpy(dtype=float)
+    sizes = df['number_of_members'].tolist()
+    starts = df['preorder_start'].tolist()
+    ends = df['preorder_end'].tolist()
+
+    lower = np.full(len(df), -np.inf)
+    chain = np.arange(len(df))
+    stack: List[Tuple[int, int, float]] = []  # (row, end, highest ratio on the path down to this row)
+    for row in np.argsort(starts).tolist():
+        while stack and stack[-1][1] <= starts[row]:
+            stack.pop()
+
+        depth = len(stack)
+        while depth and sizes[stack[depth - 1][0]] == sizes[row]:
+            depth -= 1
+        if depth < len(stack):
+            chain[row] = chain[stack[depth][0]]
+        if depth:
+            lower[row] = stack[depth - 1][2]
+
+        path_max = max(stack[-1][2], ratios[row]) if stack else ratios[row]
+        stack.append((row, ends[row], path_max))
+
+    # Of each chain of equal-size nested clades only the first row is selectable
+    first_in_chain = pd.Series(np.arange(len(df))).groupby(chain).transform('min').to_numpy()
+    selectable = np.arange(len(df)) == first_in_chain
+
+    upper = np.where(selectable, ratios, -np.inf)
+    lower = np.where(selectable, lower, -np.inf)
+    return lower, upper
+
+
+def build_selection_profile(df: pd.DataFrame) -> pd.DataFrame:
+    """Return the clades selected at any threshold, with the ratio interval over which each is selected.
+
+    A clade is among the largest non-intersecting clades for every threshold t with
+    ``selected_above < t <= selected_up_to``, so the profile describes the whole threshold curve at once.
+    Rows keep the selection order (number_of_members descending).
+    """
+    df = df.copy()
     df['crassvirales_ratio'] = pd.to_numeric(df['crassvirales_ratio'], errors='coerce')
 
     # Sort clades by the number of members in descending order
     df = df.sort_values(by='number_of_members', ascending=False)
+    lower, upper = selection_bounds(df)
 
-    # Initialize list to store selected clades
-    selected_clades: List[pd.Series] = []
-    selected_members: set = set()
+    profile = df.assign(selected_above=lower, selected_up_to=upper)
+    return profile[lower < upper]
 
-    # Iterate through the clades to find the largest non-intersecting ones
-    for index, row in df.iterrows():
-        clade_members = set(row['all_members'].split(', '))
-        if not clade_members.intersection(selected_members):
-            if row['crassvirales_ratio'] >= threshold:
-                selected_clades.append(row)
-                selected_members.update(clade_members)
 
-    selected_df = pd.DataFrame(selected_clades)
-    return selected_df
+def select_from_profile(profile: pd.DataFrame, threshold: float) -> pd.DataFrame:
+    """Return the largest non-intersecting clades at one threshold from a selection profile."""
+    selected = (profile['selected_above'] < threshold) & (threshold <= profile['selected_up_to'])
+    return profile[selected].drop(columns=SELECTION_PROFILE_COLUMNS)
 
 
-# @time_it("Save biggest non intersecting clades by thresholds")
-def save_biggest_non_intersecting_clades_by_thresholds(all_clades_path: str, output_dir: str) -> None:
-    """Save the largest non-intersecting clades filtered by Crassvirales ratio thresholds."""
-    df = pd.read_csv(all_clades_path, sep='\t')
+def expand_selection_profile(profile: pd.DataFrame, thresholds: List[float]) -> pd.DataFrame:
+    """Expand a selection profile into one table of selected clades per threshold, with a leading threshold column."""
+    all_data = []
+    for threshold in thresholds:
+        df = select_from_profile(profile, threshold)
+        df.insert(0, 'threshold', threshold)
+        all_data.append(df)
+    return pd.concat(all_data, ignore_index=True)
 
-    for i in range(0, 11):
-        threshold = i * 10  # Threshold is correctly set to 10, 20, ..., 100
-        selected_df = find_largest_non_intersecting_clades(df, float(threshold))
 
-        output_path = os.path.join(output_dir, f"biggest_non_intersecting_clades_{threshold}_percent.tsv")
-        selected_df.to_csv(output_path, sep='\t', index=False)
-        # print(f"Saved biggest non-intersecting clades for {threshold}% threshold to {output_path}")
+def select_clades_by_thresholds(df: pd.DataFrame, thresholds: List[float]) -> Dict[float, pd.DataFrame]:
+    """Find the largest non-intersecting clades for every threshold from a single sort and sweep of the table."""
+    profile = build_selection_profile(df)
+    return {threshold: select_from_profile(profile, threshold) for threshold in thresholds}
 
 
-# @time_it("Concatenate clades tables")
-def concatenate_clades_tables(output_dir: str, output_file: str) -> None:
-    """Concatenate biggest_non_intersecting_clades tables for all thresholds and save to a new output table."""
-    all_data = []
+def find_largest_non_intersecting_clades(df: pd.DataFrame, threshold: float) -> pd.DataFrame:
+    """Find the largest non-intersecting clades with Crassvirales ratio above the threshold."""
+    return select_clades_by_thresholds(df, [threshold])[threshold]
 
-    # Loop through each threshold from 0% to 100%
-    for i in range(0, 11):
-        threshold = i * 10
-        file_path = os.path.join(output_dir, f"biggest_non_intersecting_clades_{threshold}_percent.tsv")
 
-        if os.path.exists(file_path):
-            logging.debug(f"Processing file: {file_path}")
+# @time_it("Save biggest non intersecting clades by thresholds")
+def threshold_table_path(output_dir: str, threshold: float) -> str:
+    """Return the path of the table of largest non-intersecting clades for a threshold."""
+    return os.path.join(output_dir, f"biggest_non_intersecting_clades_{threshold}_percent.tsv")
 
-            try:
-                # Check if the file is empty or has no valid content
-                if os.path.getsize(file_path) == 0:
-                    logging.warning(f"{file_path} is empty and will be skipped.")
-                    continue
 
-                # Read the file and check for valid columns
-                df = pd.read_csv(file_path, sep='\t')
+def save_biggest_non_intersecting_clades_by_thresholds(all_clades: pd.DataFrame, output_dir: str, profile_path: str,
+                                                       thresholds: List[float] = DEFAULT_THRESHOLDS,
+                                                       leaves: Optional[pd.DataFrame] = None,
+                                                       write_threshold_tables: bool = True) -> pd.DataFrame:
+    """Save the clade selection profile and the largest non-intersecting clades for each threshold.
 
-                if df.empty or df.shape[1] == 0:
-                    logging.warning(f"{file_path} has no valid columns and will be skipped.")
-                    continue
+    For a compact clade table, pass its leaf table as ``leaves`` to add the member name columns to the
+    selected clades. Returns the selection profile; the per-threshold tables are only written if
+    ``write_threshold_tables`` is set.
+    """
+    profile = build_selection_profile(all_clades)
+    if leaves is not None:
+        profile = add_member_columns(profile, leaves)
+    profile.to_csv(profile_path, sep='\t', index=False)
 
-                # Insert threshold column and append to the list of dataframes
-                df.insert(0, 'threshold', threshold)
-                all_data.append(df)
+    if write_threshold_tables:
+        for threshold in thresholds:
+            output_path = threshold_table_path(output_dir, threshold)
+            select_from_profile(profile, threshold).to_csv(output_path, sep='\t', index=False)
+            # print(f"Saved biggest non-intersecting clades for {threshold}% threshold to {output_path}")
 
-            except pd.errors.EmptyDataError:
-                logging.warning(f"{file_path} could not be read (EmptyDataError) and will be skipped.")
-                continue
+    return profile
 
-        else:
-            logging.warning(f"{file_path} does not exist.")
 
-    if all_data:
-        # Concatenate all dataframes and save the result
-        concatenated_df = pd.concat(all_data, ignore_index=True)
-        concatenated_df.to_csv(output_file, sep='\t', index=False)
-        logging.info(f"Concatenated clades table saved to {output_file}")
-    else:
-        logging.warning(f"No valid data found to concatenate in {output_dir}")
+def load_selection_profile(profile_path: str) -> pd.DataFrame:
+    """Load a clade selection profile, returning an empty profile if the file has no content."""
+    try:
+        return pd.read_csv(profile_path, sep='\t')
+    except pd.errors.EmptyDataError:
+        logging.warning(f"{profile_path} could not be read (EmptyDataError).")
+        return pd.DataFrame(columns=SELECTION_PROFILE_COLUMNS)
+
+
+# @time_it("Concatenate clades tables")
+def concatenate_clades_tables(profile: pd.DataFrame, output_file: str,
+                              thresholds: List[float] = DEFAULT_THRESHOLDS) -> pd.DataFrame:
+    """Build the table of selected clades for all thresholds from the selection profile, save and return it."""
+    if profile.empty:
+        logging.warning(f"No valid data found to concatenate for {output_file}")
+        return pd.DataFrame()
+
+    concatenated_df = expand_selection_profile(profile, thresholds)
+    concatenated_df.to_csv(output_file, sep='\t', index=False)
+    logging.info(f"Concatenated clades table saved to {output_file}")
+    return concatenated_df
 
 
 # @time_it("Assign clade features")
@@ -316,8 +579,9 @@ def concatenate_clades_tables(output_dir: str, output_file: str) -> None:
 
 
 @time_it("Assign clade features")
-def assign_clade_features(tree: Tree, largest_clades: Dict[int, pd.DataFrame]) -> None:
-    """Assign clade features to each node for thresholds 0-100%."""
+def assign_clade_features(tree: Tree, largest_clades: Dict[float, pd.DataFrame],
+                          thresholds: List[float] = DEFAULT_THRESHOLDS) -> None:
+    """Assign clade features to each node for the given thresholds (0-100% in 10% steps by default)."""
 
     # Create a lookup table for tree nodes to avoid repeated calls to tree.search_nodes()
     tree_node_lookup = {node.name: node for node in tree.traverse()}
@@ -336,7 +600,7 @@ def assign_clade_features(tree: Tree, largest_clades: Dict[int, pd.DataFrame]) -
 
     # Set False for nodes not assigned to any clade at any threshold
     for node in tree.traverse():
-        for threshold in range(0, 101, 10):
+        for threshold in thresholds:
             feature_name = f'clade_{threshold}'
             if not hasattr(node, feature_name):
                 node.add_feature(feature_name, False)
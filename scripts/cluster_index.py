@@ -0,0 +1,150 @@
+import argparse
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+INDEX_COLUMNS = ['cluster', 'leaves', 'file_size', 'mtime_ns']
+
+
+def get_tree_path(trees_dir: str, cluster_name: str) -> str:
+    """Return the path of the cluster's tree."""
+    return f'{trees_dir}/{cluster_name}_ncbi_trimmed.nw'
+
+
+def count_newick_leaves(tree_path: str, chunk_size: int = 1 << 20) -> int:
+    """Count the leaves of a Newick tree as its commas plus one, without parsing it.
+
+    Leaf names in the trees are protein IDs, so commas only ever separate sibling nodes.
+    """
+    commas = 0
+    with open(tree_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            commas += chunk.count(b',')
+    return commas + 1
+
+
+def build_cluster_index(trees_dir: str, cluster_names: List[str],
+                        previous: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """Return the leaf count and tree file size and modification time of each cluster.
+
+    Clusters of ``previous`` whose tree file still has the recorded size and modification time are not counted
+    again. Clusters without a tree file get 0 leaves, size 0 and modification time 0.
+    """
+    known: Dict[str, Tuple[int, int, int]] = {}
+    if previous is not None:
+        known = {cluster: (leaves, file_size, mtime_ns)
+                 for cluster, leaves, file_size, mtime_ns in previous[INDEX_COLUMNS].itertuples(index=False)}
+
+    rows = []
+    for cluster_name in cluster_names:
+        tree_path = get_tree_path(trees_dir, cluster_name)
+        if not os.path.exists(tree_path):
+            logging.warning(f"Tree file {tree_path} does not exist.")
+            rows.append((cluster_name, 0, 0, 0))
+            continue
+        stat = os.stat(tree_path)
+        leaves, known_size, known_mtime_ns = known.get(cluster_name, (0, -1, -1))
+        if known_size != stat.st_size or known_mtime_ns != stat.st_mtime_ns:
+            leaves = count_newick_leaves(tree_path)
+        rows.append((cluster_name, leaves, stat.st_size, stat.st_mtime_ns))
+    return pd.DataFrame(rows, columns=INDEX_COLUMNS)
+
+
+def load_cluster_index(index_path: str, trees_dir: str, cluster_names: List[str]) -> pd.DataFrame:
+    """Return the cluster index saved at ``index_path``, updating the file first if any tree changed or is new.
+
+    The file is only written when it changed, and then replaced as a whole.
+    """
+    previous = pd.read_csv(index_path, sep='\t') if os.path.exists(index_path) else None
+    if previous is not None and not set(INDEX_COLUMNS).issubset(previous.columns):
+        # An index written before a column was added is rebuilt from the trees
+        previous = None
+    index = build_cluster_index(trees_dir, cluster_names, previous)
+    if previous is None or not index.equals(
+            previous.drop_duplicates('cluster', keep='last').set_index('cluster').reindex(cluster_names).reset_index()):
+        if previous is not None:
+            # Keep the entries of clusters that are not in this run
+            index = pd.concat([previous[~previous['cluster'].isin(cluster_names)], index], ignore_index=True)
+        # Every Snakemake job loads the index when it parses the Snakefile, so a concurrent reader must never see
+        # a partly written file
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        tmp_path = f'{index_path}.{os.getpid()}.tmp'
+        index.to_csv(tmp_path, sep='\t', index=False)
+        os.replace(tmp_path, index_path)
+        logging.info(f"Cluster index saved to {index_path}")
+    return index[index['cluster'].isin(cluster_names)].reset_index(drop=True)
+
+
+def largest_first(index: pd.DataFrame, cluster_names: List[str]) -> List[str]:
+    """Return the cluster names ordered by decreasing leaf count, keeping the given order between equal sizes."""
+    leaves = dict(zip(index['cluster'], index['leaves']))
+    return sorted(cluster_names, key=lambda cluster_name: -leaves.get(cluster_name, 0))
+
+
+class ResourceModel:
+    """Memory (MB) and runtime (minutes) of a cluster job as linear functions of the cluster's leaf count.
+
+    Without benchmarks the model gives every job the same fixed allocation. Estimates from fitted
+    benchmarks are scaled by ``margin`` and kept at or above the floors.
+    """
+
+    def __init__(self, mem_mb: Tuple[float, float] = (5000.0, 0.0), runtime_min: Tuple[float, float] = (30.0, 0.0),
+                 margin: float = 1.0, min_mem_mb: float = 500.0, min_runtime_min: float = 1.0) -> None:
+        # (intercept, slope per leaf) of each resource
+        self.mem_mb = mem_mb
+        self.runtime_min = runtime_min
+        self.margin = margin
+        self.min_mem_mb = min_mem_mb
+        self.min_runtime_min = min_runtime_min
+
+    @classmethod
+    def fit(cls, benchmarks: Dict[str, int], default: Optional['ResourceModel'] = None, margin: float = 1.5,
+            min_samples: int = 5) -> 'ResourceModel':
+        """Fit the model to Snakemake benchmark files, given as a mapping of file path to the job's leaf count.
+
+        Missing files are skipped; with fewer than ``min_samples`` benchmarks ``default`` (or the fixed
+        allocation) is returned. The fitted model keeps the floors of ``default``.
+        """
+        default = default if default is not None else cls()
+        samples = []
+        for benchmark_path, leaves in benchmarks.items():
+            if not os.path.exists(benchmark_path):
+                continue
+            benchmark = pd.read_csv(benchmark_path, sep='\t', na_values='-')
+            # Repeated benchmark runs are on separate rows; size for the worst one
+            samples.append((leaves, benchmark['s'].max() / 60, benchmark['max_rss'].max()))
+        data = pd.DataFrame(samples, columns=['leaves', 'runtime_min', 'mem_mb']).dropna()
+        if len(data) < min_samples or data['leaves'].nunique() < 2:
+            return default
+
+        def fit_line(values: pd.Series) -> Tuple[float, float]:
+            slope, intercept = np.polyfit(data['leaves'], values, 1)
+            return max(float(intercept), 0.0), max(float(slope), 0.0)
+
+        model = cls(fit_line(data['mem_mb']), fit_line(data['runtime_min']), margin, default.min_mem_mb,
+                    default.min_runtime_min)
+        logging.info(f"Resource model fitted to {len(data)} benchmarks: memory {model.mem_mb}, "
+                     f"runtime {model.runtime_min}")
+        return model
+
+    def estimate(self, leaves: int) -> Tuple[int, int]:
+        """Return the memory (MB) and runtime (minutes) to request for a job on a cluster of the given size."""
+        mem_mb = max((self.mem_mb[0] + self.mem_mb[1] * leaves) * self.margin, self.min_mem_mb)
+        runtime_min = max((self.runtime_min[0] + self.runtime_min[1] * leaves) * self.margin, self.min_runtime_min)
+        return int(np.ceil(mem_mb)), int(np.ceil(runtime_min))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count the leaves of each cluster's tree and save the cluster index.")
+    parser.add_argument("--trees_dir", required=True, help="Directory with the {cluster}_ncbi_trimmed.nw trees.")
+    parser.add_argument("--clusters_file", required=True, help="File with one cluster name per line.")
+    parser.add_argument("--output", required=True, help="Path to the cluster index TSV to create or update.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s\t%(levelname)s\t%(message)s')
+    with open(args.clusters_file) as f:
+        clusters = [line.strip() for line in f if line.strip()]
+    load_cluster_index(args.output, args.trees_dir, clusters)
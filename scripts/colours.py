@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Tuple
 
 source_colors: Dict[str, str] = {
     'ncbi': '#1f78b4',  # Steel Blue
@@ -26,3 +26,17 @@ phylum_colors: Dict[str, str] = {
 }
 
 crassvirales_color = '#fb9a99'  # Light Pink
+
+# Box colour of each annotated taxonomy feature: (feature, colours by value, colour of other values)
+TAXONOMY_BOX_COLORS: Tuple[Tuple[str, Dict[str, str], str], ...] = (
+    ('source', source_colors, 'gray'),
+    ('superkingdom', superkingdom_colors, superkingdom_colors['Other']),
+    ('phylum', phylum_colors, 'gray'),
+    ('order', {'Crassvirales': crassvirales_color}, 'gray'),
+)
+
+# Box colours of the collapsed nodes of a summary tree, by kind
+COLLAPSED_COLORS: Dict[str, str] = {
+    'clade': crassvirales_color,  # a selected clade
+    'other': 'lightgray',  # a subtree without selected clades
+}
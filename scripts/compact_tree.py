@@ -0,0 +1,283 @@
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from ete3 import Tree
+
+from taxonomy_codes import MISSING, TAXONOMY_FEATURES, AnnotationCodes, TaxonomyVocabulary
+
+
+class CompactTree:
+    """Phylogenetic tree held in NumPy arrays, with nodes numbered in preorder.
+
+    Node ``i`` has parent ``parent[i]`` (-1 for the root), children
+    ``child_index[child_offsets[i]:child_offsets[i + 1]]`` and descendants ``i + 1 .. subtree_end[i] - 1``,
+    so every clade is a contiguous index range. Leaf annotations are kept as a (nodes x TAXONOMY_FEATURES)
+    array of codes into ``vocabulary`` (MISSING for internal or unannotated nodes). Per-node values computed
+    by the analysis stages are stored in ``features`` and copied onto the nodes by to_ete. ``origin`` maps each
+    node to its index in the input the tree was built from: the ete3 preorder for from_ete, the tree it was
+    rerooted from for set_outgroup (-1 for the node set_outgroup adds).
+    """
+
+    def __init__(self, parent: np.ndarray, child_offsets: np.ndarray, child_index: np.ndarray, dist: np.ndarray,
+                 support: np.ndarray, names: List[str], taxonomy: np.ndarray,
+                 vocabulary: TaxonomyVocabulary) -> None:
+        self.parent = parent
+        self.child_offsets = child_offsets
+        self.child_index = child_index
+        self.dist = dist
+        self.support = support
+        self.names = names
+        self.taxonomy = taxonomy
+        self.vocabulary = vocabulary
+        self.subtree_end = self._compute_subtree_end()
+        self.features: Dict[str, Sequence[Any]] = {}
+        self.origin: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    @property
+    def is_leaf(self) -> np.ndarray:
+        """Boolean mask of leaf nodes."""
+        return self.child_offsets[1:] == self.child_offsets[:-1]
+
+    @property
+    def leaf_indices(self) -> np.ndarray:
+        """Indices of the leaves, in preorder (the same order as ete3's iter_leaves)."""
+        return np.flatnonzero(self.is_leaf)
+
+    def children(self, node: int) -> np.ndarray:
+        """Return the children of a node, in order."""
+        return self.child_index[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def taxonomy_mask(self, feature: str, value: Any) -> np.ndarray:
+        """Boolean mask of the nodes whose taxonomy feature has the given value."""
+        code = self.vocabulary.find(feature, value)
+        if code is None:
+            return np.zeros(len(self), dtype=bool)
+        return self.taxonomy[:, TAXONOMY_FEATURES.index(feature)] == code
+
+    def _compute_subtree_end(self) -> np.ndarray:
+        sizes = [1] * len(self.parent)
+        parent = self.parent.tolist()
+        for node in range(len(parent) - 1, 0, -1):
+            sizes[parent[node]] += sizes[node]
+        return np.arange(len(parent), dtype=np.int32) + np.asarray(sizes, dtype=np.int32)
+
+    def postorder(self) -> List[int]:
+        """Return node indices in postorder (the same order as ete3's traverse('postorder'))."""
+        order = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(self.children(node).tolist())
+        order.reverse()
+        return order
+
+    def subtree_sums(self, values: np.ndarray) -> np.ndarray:
+        """Sum per-node values over every subtree at once, using prefix sums over the preorder ranges."""
+        prefix = np.zeros((len(self) + 1,) + values.shape[1:], dtype=values.dtype)
+        np.cumsum(values, axis=0, out=prefix[1:])
+        return prefix[self.subtree_end] - prefix[:-1]
+
+    def distances_to_root(self) -> np.ndarray:
+        """Return the branch-length distance from the root to every node, in one top-down pass."""
+        parent = self.parent.tolist()
+        dist = self.dist.tolist()
+        distances = [0.0] * len(parent)
+        # Parents precede their children in preorder
+        for node in range(1, len(parent)):
+            distances[node] = distances[parent[node]] + dist[node]
+        return np.asarray(distances)
+
+    def get_midpoint_outgroup(self) -> int:
+        """Return the node that splits the tree into two distance-balanced partitions.
+
+        Same procedure as ete3's TreeNode.get_midpoint_outgroup: take the leaf A farthest from the root and
+        the leaf B farthest from A, then walk up from A until half of the A-B distance is passed. Ties are
+        broken the same way (first leaf in preorder), but every step is a vectorized linear pass.
+        """
+        leaves = self.leaf_indices
+        depth = self.distances_to_root()
+        leaf_a = int(leaves[np.argmax(depth[leaves])])
+
+        # Ancestors of A from the root down; the deepest one whose subtree holds a leaf is their common ancestor
+        path = [leaf_a]
+        while path[-1] > 0:
+            path.append(int(self.parent[path[-1]]))
+        path_nodes = np.asarray(path[::-1])
+        ends = self.subtree_end[path_nodes]
+        deepest_start = np.searchsorted(path_nodes, leaves, side='right') - 1
+        deepest_end = np.searchsorted(-ends, -leaves, side='left') - 1
+        common_ancestor = path_nodes[np.minimum(deepest_start, deepest_end)]
+        diameter = float(np.max(depth[leaf_a] + depth[leaves] - 2 * depth[common_ancestor]))
+
+        # Walk up from A (root branch included, as in ete3) until more than half the diameter is covered
+        climbed = np.cumsum(self.dist[path_nodes[::-1]])
+        passed = np.flatnonzero(climbed > diameter / 2.0)
+        if len(passed) == 0:
+            # The walk passed the root, so the tree is already rooted at its midpoint
+            return int(self.children(0)[0])
+        return int(path_nodes[::-1][passed[0]])
+
+    def _child_lists(self) -> List[List[int]]:
+        child_index = self.child_index.tolist()
+        offsets = self.child_offsets.tolist()
+        return [child_index[offsets[node]:offsets[node + 1]] for node in range(len(self))]
+
+    def set_outgroup(self, outgroup: int) -> 'CompactTree':
+        """Return a copy of the tree rerooted on the branch above ``outgroup``.
+
+        Mirrors ete3's TreeNode.set_outgroup step by step (the root keeps its name, extra root children are
+        grouped under a new unnamed node, the outgroup becomes the first child), so the rerooted tree, its
+        child order and its branch lengths are the same as those ete3 produces.
+        """
+        if outgroup == 0:
+            raise ValueError("Cannot set the root as outgroup")
+
+        children = self._child_lists()
+        up = self.parent.tolist()
+        dist = self.dist.tolist()
+        support = self.support.tolist()
+        names = list(self.names)
+        taxonomy = self.taxonomy
+
+        parent_outgroup = up[outgroup]
+
+        # Child of the root leading to the outgroup
+        n = outgroup
+        while up[n] != 0:
+            n = up[n]
+
+        children[0].remove(n)
+        if len(children[0]) != 1:
+            down_branch_connector = len(children)
+            children.append(children[0])
+            up.append(-1)
+            dist.append(0.0)
+            support.append(support[n])
+            names.append('')
+            taxonomy = np.vstack([taxonomy, np.full((1, taxonomy.shape[1]), MISSING, dtype=taxonomy.dtype)])
+            for child in children[0]:
+                up[child] = down_branch_connector
+            children[0] = []
+        else:
+            down_branch_connector = children[0][0]
+
+        if parent_outgroup != 0:
+            # Reverse the parent-child links on the path from the outgroup up to the root
+            new_parent = parent_outgroup
+            new_child = up[new_parent]
+            former_parent = -1
+            buffered_dist = dist[new_parent]
+            buffered_support = support[new_parent]
+            while new_child != 0:
+                children[new_parent].append(new_child)
+                children[new_child].remove(new_parent)
+                buffered_dist, dist[new_child] = dist[new_child], buffered_dist
+                buffered_support, support[new_child] = support[new_child], buffered_support
+                up[new_parent] = former_parent
+                former_parent = new_parent
+                new_parent = new_child
+                new_child = up[new_parent]
+            children[new_parent].append(down_branch_connector)
+            up[down_branch_connector] = new_parent
+            up[new_parent] = former_parent
+            dist[down_branch_connector] += buffered_dist
+            outgroup2 = parent_outgroup
+            children[parent_outgroup].remove(outgroup)
+            dist[outgroup2] = 0.0
+        else:
+            outgroup2 = down_branch_connector
+
+        up[outgroup] = 0
+        up[outgroup2] = 0
+        children[0] = [outgroup, outgroup2]
+        middist = (dist[outgroup2] + dist[outgroup]) / 2
+        dist[outgroup] = middist
+        dist[outgroup2] = middist
+        support[outgroup2] = support[outgroup]
+
+        rerooted = CompactTree.from_adjacency(0, children, dist, support, names, taxonomy, self.vocabulary)
+        origin = rerooted.origin
+        if origin is not None:
+            origin[origin >= len(self)] = -1
+        return rerooted
+
+    @classmethod
+    def from_adjacency(cls, root: int, children: List[List[int]], dist: Sequence[float], support: Sequence[float],
+                       names: List[str], taxonomy: np.ndarray, vocabulary: TaxonomyVocabulary) -> 'CompactTree':
+        """Build a compact tree from per-node child lists, renumbering the nodes in preorder."""
+        order = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(reversed(children[node]))
+
+        n_nodes = len(order)
+        position = np.full(len(children), -1, dtype=np.int32)
+        position[order] = np.arange(n_nodes, dtype=np.int32)
+
+        child_counts = np.fromiter((len(children[node]) for node in order), dtype=np.int32, count=n_nodes)
+        child_offsets = np.zeros(n_nodes + 1, dtype=np.int32)
+        np.cumsum(child_counts, out=child_offsets[1:])
+        child_index = position[[child for node in order for child in children[node]]].astype(np.int32)
+
+        parent = np.full(n_nodes, -1, dtype=np.int32)
+        parent[child_index] = np.repeat(np.arange(n_nodes, dtype=np.int32), child_counts)
+
+        tree = cls(parent, child_offsets, child_index,
+                   np.asarray(dist, dtype=np.float64)[order], np.asarray(support, dtype=np.float64)[order],
+                   [names[node] for node in order], taxonomy[order], vocabulary)
+        tree.origin = np.asarray(order, dtype=np.int32)
+        return tree
+
+    @classmethod
+    def from_ete(cls, tree: Tree, annotations: Optional[AnnotationCodes] = None,
+                 partial: bool = False) -> 'CompactTree':
+        """Build a compact tree from an ete3 tree.
+
+        With ``annotations``, the leaves are annotated by name from the coded annotation table (like
+        tree_utils.annotate_tree_id, or tree_utils.annotate_tree with ``partial``); otherwise the taxonomy
+        features already set on the leaves are encoded.
+        """
+        nodes = list(tree.traverse('preorder'))
+        index = {node: i for i, node in enumerate(nodes)}
+        children = [[index[child] for child in node.children] for node in nodes]
+
+        taxonomy = np.full((len(nodes), len(TAXONOMY_FEATURES)), MISSING, dtype=np.int32)
+        if annotations is not None:
+            leaves = [i for i, node in enumerate(nodes) if node.is_leaf()]
+            taxonomy[leaves] = annotations.lookup([nodes[i].name for i in leaves], partial)
+            vocabulary = annotations.vocabulary
+        else:
+            annotated = [i for i, node in enumerate(nodes) if node.is_leaf() and 'superkingdom' in node.features]
+            vocabulary, codes = TaxonomyVocabulary.factorize(
+                [[getattr(nodes[i], feature) for i in annotated] for feature in TAXONOMY_FEATURES])
+            taxonomy[annotated] = codes
+
+        return cls.from_adjacency(0, children, [node.dist for node in nodes], [node.support for node in nodes],
+                                  [node.name for node in nodes], taxonomy, vocabulary)
+
+    def to_ete(self) -> Tree:
+        """Convert back to an ete3 tree with taxonomy and computed features, e.g. for rendering."""
+        nodes = []
+        for i in range(len(self)):
+            node = Tree()
+            node.name = self.names[i]
+            node.dist = float(self.dist[i])
+            node.support = float(self.support[i])
+            taxonomy = self.vocabulary.decode(self.taxonomy[i].tolist())
+            if taxonomy is not None:
+                node.add_features(**dict(zip(TAXONOMY_FEATURES, taxonomy)))
+            nodes.append(node)
+            if i > 0:
+                nodes[self.parent[i]].add_child(node)
+
+        for feature_name, values in self.features.items():
+            for node, value in zip(nodes, values):
+                node.add_feature(feature_name, value)
+
+        return nodes[0]
@@ -1,10 +1,27 @@
+import atexit
 import logging
 import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 
+# Handler through which the root logger queues its records, and the thread that writes them out
+_queue_handler: Optional[QueueHandler] = None
+_listener: Optional[QueueListener] = None
 
-def setup_logging(output_dir: str, cluster_name: str, logging_level=logging.INFO) -> None:
-    """Set up logging configuration to save logs in the specified output directory, including the cluster name."""
-    log_file_path = os.path.join(output_dir, f'{cluster_name}_log_tree_analysis.log')
+
+def setup_logging(output_dir: str, cluster_name: str, logging_level=logging.INFO,
+                  log_name: str = 'log_tree_analysis') -> None:
+    """Set up logging configuration to save logs in the specified output directory, including the cluster name.
+
+    The log file is {cluster_name}_{log_name}.log. Logging only puts records on a queue; a background thread
+    writes them to the log file and the console, so that slow writes to the shared filesystem do not hold up
+    the analysis.
+    """
+    log_file_path = os.path.join(output_dir, f'{cluster_name}_{log_name}.log')
+
+    # Write out the records of the previous configuration before replacing it
+    stop_logging()
 
     # Get the root logger
     logger = logging.getLogger()
@@ -17,18 +34,40 @@ def setup_logging(output_dir: str, cluster_name: str, logging_level=logging.INFO
     # log_format = f'%(asctime)s - %(levelname)s - {cluster_name} - %(message)s'
     # log_format = f'%(asctime)s\t%(levelname)s\t{cluster_name}\t%(message)s\t%(module)s\t%(funcName)s'
     log_format = '%(asctime)s\t%(levelname)s\t' + cluster_name + '\t%(message)s\t%(module)s\t%(funcName)s'
+    formatter = logging.Formatter(log_format)
 
     # Set up logging to file with the updated format
-    logging.basicConfig(
-        filename=log_file_path,
-        level=logging_level,
-        format=log_format,
-        filemode='w'  # Overwrite log file for each cluster run
-    )
+    file_handler = logging.FileHandler(log_file_path, mode='w')  # Overwrite log file for each cluster run
+    file_handler.setFormatter(formatter)
 
     # Optional: Set up console logging to print logs to the console (only once)
     console = logging.StreamHandler()
     console.setLevel(logging_level)
-    formatter = logging.Formatter(log_format)
     console.setFormatter(formatter)
-    logger.addHandler(console)
+
+    global _queue_handler, _listener
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _queue_handler = QueueHandler(log_queue)
+    logger.addHandler(_queue_handler)
+    logger.setLevel(logging_level)
+    _listener = QueueListener(log_queue, file_handler, console, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """Write out the queued records and close the handlers set up by setup_logging.
+
+    Called at exit; call it explicitly in processes that end without running exit handlers (forked workers).
+    """
+    global _queue_handler, _listener
+    if _listener is None or _queue_handler is None:
+        return
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _queue_handler = None
+    _listener = None
+
+
+atexit.register(stop_logging)
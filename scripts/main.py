@@ -1,23 +1,38 @@
 import argparse
 import glob
+import importlib
 import logging
+import multiprocessing
 import os
+import sys
 import yaml
-from typing import Dict
-
-# import pandas as pd
-
-from clade_analysis import assign_clade_features, save_clade_statistics, \
-    concatenate_clades_tables, save_biggest_non_intersecting_clades_by_thresholds
-from logging_utils import setup_logging
-from plot_tree import save_tree_plot
-from plotting import generate_plots
-from tree_utils import load_tree, load_annotations, annotate_tree_id, assign_unique_ids, \
-    ensure_directory_exists, root_tree_at_bacteria
-from utils import time_it
+from multiprocessing.connection import wait
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from annotation_store import fetch_annotations
+from clade_analysis import BipartitionCounts, assign_clade_features, build_clade_statistics, build_leaf_table, \
+    concatenate_clades_tables, expand_selection_profile, load_selection_profile, save_clade_statistics, \
+    save_biggest_non_intersecting_clades_by_thresholds, save_leaf_table, select_from_profile, threshold_grid, \
+    threshold_table_path
+from cluster_index import get_tree_path, largest_first, load_cluster_index
+from compact_tree import CompactTree
+from logging_utils import setup_logging, stop_logging
+from manifest import StageManifest, cached_file_digest, code_digest, digest_cache_dir, file_digest, fingerprint
+from taxonomy_codes import AnnotationCodes
+from tree_utils import load_tree, load_annotations, assign_unique_ids, \
+    ensure_directory_exists, load_annotated_tree, root_compact_tree_at_bacteria, save_annotated_tree
+from utils import start_metrics, time_it, update_metrics_context
+
+TREE_TYPES = ['rooted', 'unrooted', 'midpoint']
+# Module and file format of each tree plot renderer: ete3 needs Qt, svg draws from the compact tree without it
+TREE_PLOT_BACKENDS = {'ete3': ('plot_tree', 'pdf'), 'svg': ('tree_svg', 'svg')}
 
 # Set environment variable for non-interactive backend
 os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+os.environ['MPLBACKEND'] = 'Agg'
 
 
 def read_cluster_names_from_file(file_path: str) -> list[str]:
@@ -37,6 +52,7 @@ def format_paths(config: dict) -> dict:
     phylogenetic_trees_dir = config["input"]["phylogenetic_trees_dir"].format(deni_data=working_dir)
     annotation_file = config["input"]["annotation_file"].format(tree_leaves=tree_leaves)
     annotation_file_id = config["input"]["annotation_file_id"].format(tree_leaves=tree_leaves)
+    annotation_store = (config["input"].get("annotation_store") or "").format(tree_leaves=tree_leaves)
     config_dir = config["input"]["config_dir"].format(wd=wd)
     clusters_file = config["input"]["clusters_file"].format(config_dir=config_dir)
 
@@ -44,6 +60,9 @@ def format_paths(config: dict) -> dict:
     base_output_dir = config["output"].get("base_output_dir", "").format(wd=wd)
     # output_dir = config["output"].get("output_dir", "").format(wd=wd)
     logs_dir = config["output"].get("logs_dir", "").format(base_output_dir=base_output_dir)
+    cluster_index = (config["output"].get("cluster_index") or "").format(base_output_dir=base_output_dir)
+    benchmarks_dir = (config["output"].get("benchmarks_dir") or "").format(base_output_dir=base_output_dir)
+    metrics_dir = (config["output"].get("metrics_dir") or "").format(base_output_dir=base_output_dir)
 
     # Update the config with formatted paths
     config["input"]["deni_data"] = working_dir
@@ -52,12 +71,16 @@ def format_paths(config: dict) -> dict:
     config["input"]["phylogenetic_trees_dir"] = phylogenetic_trees_dir
     config["input"]["annotation_file"] = annotation_file
     config["input"]["annotation_file_id"] = annotation_file_id
+    config["input"]["annotation_store"] = annotation_store
     config["input"]["config_dir"] = config_dir
     config["input"]["clusters_file"] = clusters_file
 
     config["output"]["base_output_dir"] = base_output_dir
     # config["output"]["output_dir"] = output_dir
     config["output"]["logs_dir"] = logs_dir
+    config["output"]["cluster_index"] = cluster_index
+    config["output"]["benchmarks_dir"] = benchmarks_dir
+    config["output"]["metrics_dir"] = metrics_dir
 
     return config
 
@@ -70,13 +93,54 @@ def setup_paths(config: Dict) -> Dict[str, str]:
         'trees_dir': config['input']['phylogenetic_trees_dir'],
         'annotation_path': config['input']['annotation_file'],
         'annotation_path_id': config['input']['annotation_file_id'],
+        'annotation_store': config['input']['annotation_store'],
         'base_output_dir': config['output']['base_output_dir'],
         'config_dir': config['input']['config_dir'],
-        'clusters_file': config['input']['clusters_file']
+        'clusters_file': config['input']['clusters_file'],
+        'cluster_index': config['output']['cluster_index'],
+        'metrics_dir': config['output']['metrics_dir']
     }
     return paths
 
 
+def get_thresholds(config: Dict) -> List[float]:
+    """Return the Crassvirales ratio thresholds (%) configured under 'thresholds' (0-100% in 10% steps by default)."""
+    grid = config.get('thresholds') or {}
+    return threshold_grid(grid.get('start', 0), grid.get('stop', 100), grid.get('step', 10))
+
+
+def setup_options(config: Dict, stats_only: bool = False) -> Dict[str, Any]:
+    """Setup and return the analysis options from the configuration file; ``stats_only`` turns off rendering."""
+    clade_tables = config.get('clade_tables') or {}
+    render = config.get('render') or {}
+    metrics = config.get('metrics') or {}
+    annotation_matching = config['input'].get('annotation_matching', 'exact')
+    if annotation_matching not in ('exact', 'prefix'):
+        raise ValueError(f"Unknown annotation_matching '{annotation_matching}', expected 'exact' or 'prefix'")
+    tree_plot_mode = render.get('tree_plot_mode', 'summary')
+    if tree_plot_mode not in ('summary', 'full'):
+        raise ValueError(f"Unknown tree_plot_mode '{tree_plot_mode}', expected 'summary' or 'full'")
+    tree_plot_backend = render.get('tree_plot_backend', 'ete3')
+    if tree_plot_backend not in TREE_PLOT_BACKENDS:
+        raise ValueError(f"Unknown tree_plot_backend '{tree_plot_backend}', expected one of {list(TREE_PLOT_BACKENDS)}")
+    options = {
+        'annotation_matching': annotation_matching,
+        'thresholds': get_thresholds(config),
+        'compact_clade_table': clade_tables.get('compact', False),
+        'selected_clade_members': clade_tables.get('selected_members', True),
+        'write_threshold_tables': clade_tables.get('threshold_tables', True),
+        'incremental': config.get('incremental', True),
+        'render_plots': render.get('plots', True) and not stats_only,
+        'render_tree': render.get('tree_plot', True) and not stats_only,
+        'tree_plot_mode': tree_plot_mode,
+        'tree_plot_backend': tree_plot_backend,
+        'defer_tree_plot': render.get('deferred', False),
+        'summary_threshold': render.get('summary_threshold', 90),
+        'trace_memory': metrics.get('trace_memory', False)
+    }
+    return options
+
+
 def setup_output_paths(base_output_dir: str, cluster_name: str, tree_type: str) -> Dict[str, str]:
     """Setup and return output paths for each tree type."""
     output_dir = f'{base_output_dir}/{cluster_name}/{tree_type}'
@@ -87,31 +151,66 @@ def setup_output_paths(base_output_dir: str, cluster_name: str, tree_type: str)
         'annotated_tree': f'{output_dir}/annotated_tree.nw',
         'clade_statistics': f'{output_dir}/clade_statistics.tsv',
         'all_clades': f'{output_dir}/all_clades.tsv',
+        'clade_leaves': f'{output_dir}/clade_leaves.tsv',
+        'selection_profile': f'{output_dir}/clade_selection_profile.tsv',
         'largest_non_intersecting_clades': f'{output_dir}/largest_non_intersecting_clades.tsv',
         'biggest_non_intersecting_clades_all': f'{output_dir}/biggest_non_intersecting_clades_all.tsv'
     }
 
 
-@time_it(message="process and save tree")
-def process_and_save_tree(cluster_name: str, tree_type: str, tree_path: str, annotation_dict: dict,
-                          output_paths: Dict[str, str],
-                          align_labels: bool = False, align_boxes: bool = False,
-                          logging_level=logging.INFO) -> None:
-    # cluster_name = extract_cluster_name(tree_path)
-    setup_logging(output_paths['output_dir'], cluster_name, logging_level=logging_level)
+@time_it(message="load and annotate tree")
+def load_base_tree(paths: Dict[str, str], cluster_name: str, options: Dict[str, Any],
+                   annotations: Optional[AnnotationCodes] = None) -> CompactTree:
+    """Parse and annotate the cluster's tree once; every tree type is derived from this base tree.
 
-    tree = load_tree(tree_path)
-    annotate_tree_id(tree, annotation_dict)
+    The annotations are loaded for the cluster unless already loaded ones are passed in.
+    """
+    tree = load_tree(get_tree_path(paths['trees_dir'], cluster_name))
     assign_unique_ids(tree)
 
+    if annotations is None:
+        annotations = load_annotation_codes(paths, tree.get_leaf_names(), options['annotation_matching'])
+
+    # The analysis stages run on the array-backed tree; ete3 is only needed again for rendering
+    return CompactTree.from_ete(tree, annotations, partial=options['annotation_matching'] == 'prefix')
+
+
+def root_tree(base_tree: CompactTree, tree_type: str, cluster_name: str) -> CompactTree:
+    """Return the base tree rooted for the given tree type; rerooting copies the tree, the base is left as is."""
     if tree_type == 'rooted':
-        root_tree_at_bacteria(tree)
         logging.info(f"Processing rooted tree for cluster {cluster_name}.")
+        return root_compact_tree_at_bacteria(base_tree)
     elif tree_type == 'midpoint':
-        tree.set_outgroup(tree.get_midpoint_outgroup())
         logging.info(f"Processing midpoint rooted tree for cluster {cluster_name}.")
+        return base_tree.set_outgroup(base_tree.get_midpoint_outgroup())
     elif tree_type == 'unrooted':
         logging.info(f"Processing unrooted tree for cluster {cluster_name}. No re-rooting applied.")
+    return base_tree
+
+
+@time_it(message="process and save tree")
+def process_and_save_tree(cluster_name: str, tree_type: str, base_tree: CompactTree,
+                          output_paths: Dict[str, str], options: Dict[str, Any],
+                          align_labels: bool = False, align_boxes: bool = False,
+                          logging_level=logging.INFO,
+                          bipartitions: Optional[BipartitionCounts] = None,
+                          manifests: Optional[Dict[str, StageManifest]] = None) -> Optional[pd.DataFrame]:
+    """Save the clade tables and the tree plot of a tree type, and return the selected clades for the plots.
+
+    With a deferred tree plot, the annotated tree is saved for render_cluster instead. With ``manifests``,
+    stages whose outputs are up to date are skipped; None is returned if the threshold tables were.
+    """
+    # cluster_name = extract_cluster_name(tree_path)
+    setup_logging(output_paths['output_dir'], cluster_name, logging_level=logging_level)
+
+    run_statistics = start_stage(manifests, 'clade_statistics')
+    run_tables = start_stage(manifests, 'threshold_tables')
+    tree_plot_stage = 'annotated_tree' if options['defer_tree_plot'] else 'tree_plot'
+    run_tree_plot = options['render_tree'] and start_stage(manifests, tree_plot_stage)
+    if not (run_statistics or run_tables or run_tree_plot):
+        return None
+
+    compact_tree = root_tree(base_tree, tree_type, cluster_name)
 
     largest_clades = {}
     # for i in range(0, 11):
@@ -140,42 +239,266 @@ def process_and_save_tree(cluster_name: str, tree_type: str, tree_path: str, ann
     #         logging.warning(f"Warning: {clades_file} does not exist.")
     #         # print(f"Warning: {clades_file} does not exist.")
 
-    assign_clade_features(tree, largest_clades)
+    thresholds = options['thresholds']
+    compact = options['compact_clade_table']
+    if run_statistics:
+        all_clades = save_clade_statistics(compact_tree, cluster_name, output_paths['all_clades'], compact,
+                                           bipartitions)
+        leaves = save_leaf_table(compact_tree, output_paths['clade_leaves']) if compact else None
+        record_stage(manifests, 'clade_statistics',
+                     [output_paths['all_clades']] + ([output_paths['clade_leaves']] if compact else []))
+    else:
+        # The saved statistics are up to date, but the threshold tables select from them and building them sets
+        # the node features drawn in the tree plot
+        all_clades = build_clade_statistics(compact_tree, cluster_name, compact, bipartitions)
+        leaves = build_leaf_table(compact_tree) if compact and run_tables else None
+
+    profile = None
+    selected_clades = None
+    if run_tables:
+        profile = save_biggest_non_intersecting_clades_by_thresholds(
+            all_clades, output_paths['output_dir'], output_paths['selection_profile'], thresholds,
+            leaves if options['selected_clade_members'] else None, options['write_threshold_tables'])
+        selected_clades = concatenate_clades_tables(profile, output_paths['biggest_non_intersecting_clades_all'],
+                                                    thresholds)
+        table_paths = [output_paths['selection_profile']]
+        if options['write_threshold_tables']:
+            table_paths += [threshold_table_path(output_paths['output_dir'], threshold) for threshold in thresholds]
+        if not selected_clades.empty:
+            table_paths.append(output_paths['biggest_non_intersecting_clades_all'])
+        record_stage(manifests, 'threshold_tables', table_paths)
+
+    if run_tree_plot and options['defer_tree_plot']:
+        save_annotated_tree(compact_tree, output_paths['annotated_tree'])
+        record_stage(manifests, 'annotated_tree', [output_paths['annotated_tree']])
+    elif run_tree_plot:
+        render_tree_plot(compact_tree, output_paths, options, profile, largest_clades, align_labels, align_boxes)
+        record_stage(manifests, 'tree_plot', [tree_plot_file(output_paths, options)])
+
+    return selected_clades
+
+
+def render_tree_plot(compact_tree: CompactTree, output_paths: Dict[str, str], options: Dict[str, Any],
+                     profile: Optional[pd.DataFrame] = None, largest_clades: Optional[Dict[float, pd.DataFrame]] = None,
+                     align_labels: bool = False, align_boxes: bool = True) -> None:
+    """Render the tree plot of a tree type with the configured mode and backend.
+
+    The summary collapses the clades selected at the summary threshold in ``profile``, which is read from the
+    saved selection profile if not passed.
+    """
+    svg = options['tree_plot_backend'] == 'svg'
+    if options['tree_plot_mode'] == 'summary':
+        if profile is None:
+            profile = load_selection_profile(output_paths['selection_profile'])
+        summary_threshold = options['summary_threshold']
+        clade_roots = select_from_profile(profile, summary_threshold)['preorder_start'] if not profile.empty \
+            else []
+        if svg:
+            from tree_svg import save_summary_tree_svg
+
+            save_summary_tree_svg(compact_tree, clade_roots, output_paths['tree_plot'], summary_threshold)
+        else:
+            # Imported here, as it pulls in the Qt-based ete3 renderer
+            from plot_tree import save_summary_tree_plot
+
+            save_summary_tree_plot(compact_tree, clade_roots, output_paths['tree_plot'], summary_threshold)
+    elif svg:
+        from tree_svg import save_tree_svg
+
+        save_tree_svg(compact_tree, output_paths['tree_plot'], options['thresholds'])
+    else:
+        from plot_tree import save_tree_plot
 
-    save_clade_statistics(tree, cluster_name, output_paths['all_clades'])
-    save_biggest_non_intersecting_clades_by_thresholds(output_paths['all_clades'], output_paths['output_dir'])
-    save_tree_plot(tree, output_paths['tree_plot'], align_labels=align_labels, align_boxes=align_boxes)
+        tree = compact_tree.to_ete()
+        assign_clade_features(tree, largest_clades or {}, options['thresholds'])
+        save_tree_plot(tree, output_paths['tree_plot'], align_labels=align_labels, align_boxes=align_boxes,
+                       thresholds=options['thresholds'])
 
 
 @time_it(message="cluster: {cluster_name}")
-def process_cluster(cluster_name: str, tree_types: list[str], paths: Dict[str, str], annotation_dict: dict) -> None:
-    """Process a single cluster by generating trees, saving outputs, and creating plots."""
+def process_cluster(cluster_name: str, tree_types: list[str], paths: Dict[str, str],
+                    options: Dict[str, Any], annotations: Optional[AnnotationCodes] = None) -> None:
+    """Process a single cluster by generating trees, saving outputs, and creating plots.
+
+    In incremental mode, tree types whose outputs are all up to date are skipped, and the tree is only
+    parsed and annotated if some tree type is not.
+    """
+    if paths['metrics_dir']:
+        # One metrics file per job: a cluster's tree types may be processed by separate jobs
+        metrics_file = os.path.join(paths['metrics_dir'], f"{cluster_name}_{'+'.join(tree_types)}.jsonl")
+        start_metrics(metrics_file, options['trace_memory'], cluster=cluster_name, tree_type=None, leaves=None)
+
+    tree_key = tree_fingerprint(paths, cluster_name, options) if options['incremental'] else None
+    base_tree = None
+    bipartitions = None
 
     for tree_type in tree_types:
         output_paths = setup_output_paths(paths['base_output_dir'], cluster_name, tree_type)
 
         setup_logging(output_paths['output_dir'], cluster_name)
+        update_metrics_context(tree_type=tree_type)
+
+        manifests = stage_manifests(output_paths['output_dir'], tree_key, tree_type, options) if tree_key else None
+        if manifests is not None and all(manifest.is_current() for manifest in manifests.values()):
+            logging.info(f"All outputs of {tree_type} cluster {cluster_name} are up to date, skipping")
+            continue
+
+        if base_tree is None:
+            update_metrics_context(tree_type=None)
+            base_tree = load_base_tree(paths, cluster_name, options, annotations)
+            update_metrics_context(tree_type=tree_type, leaves=len(base_tree.leaf_indices))
+            # Leaf counts on both sides of every edge, from which each rooting's clade counts are read off
+            bipartitions = BipartitionCounts(base_tree)
+
+        process_tree_type(tree_type, cluster_name, base_tree, paths['base_output_dir'], options, bipartitions,
+                          manifests)
+
+    update_metrics_context(tree_type=None)
+
+
+@time_it(message="render cluster: {cluster_name}")
+def render_cluster(cluster_name: str, tree_types: list[str], paths: Dict[str, str], options: Dict[str, Any]) -> None:
+    """Render the deferred tree plots of a cluster from the annotated trees saved by process_cluster.
+
+    Logs go to {cluster_name}_log_tree_render.log, next to the log of the cluster's analysis.
+    """
+    if not options['render_tree']:
+        logging.warning(f"Tree plots are turned off in the config, nothing to render for cluster {cluster_name}")
+        return
+
+    if paths['metrics_dir']:
+        metrics_file = os.path.join(paths['metrics_dir'], f"{cluster_name}_{'+'.join(tree_types)}_render.jsonl")
+        start_metrics(metrics_file, options['trace_memory'], cluster=cluster_name, tree_type=None, leaves=None)
+
+    for tree_type in tree_types:
+        output_paths = setup_output_paths(paths['base_output_dir'], cluster_name, tree_type)
+        setup_logging(output_paths['output_dir'], cluster_name, log_name='log_tree_render')
+        update_metrics_context(tree_type=tree_type)
 
-        process_tree_type(tree_type, cluster_name, paths['trees_dir'], annotation_dict, paths['base_output_dir'])
+        manifests = None
+        if options['incremental']:
+            inputs = {'annotated_tree': file_digest(output_paths['annotated_tree'])}
+            if options['tree_plot_mode'] == 'summary':
+                inputs['selection_profile'] = file_digest(output_paths['selection_profile'])
+            manifests = {'tree_plot': tree_plot_manifest(output_paths['output_dir'], options, **inputs)}
+        if not start_stage(manifests, 'tree_plot'):
+            continue
+
+        compact_tree = load_annotated_tree(output_paths['annotated_tree'])
+        update_metrics_context(leaves=len(compact_tree.leaf_indices))
+        render_tree_plot(compact_tree, output_paths, options)
+        record_stage(manifests, 'tree_plot', [tree_plot_file(output_paths, options)])
+
+    update_metrics_context(tree_type=None)
 
 
 @time_it(message="{tree_type} cluster: {cluster_name}")
-def process_tree_type(tree_type: str, cluster_name: str, trees_dir: str, annotation_dict: dict,
-                      base_output_dir: str) -> None:
+def process_tree_type(tree_type: str, cluster_name: str, base_tree: CompactTree,
+                      base_output_dir: str, options: Dict[str, Any],
+                      bipartitions: Optional[BipartitionCounts] = None,
+                      manifests: Optional[Dict[str, StageManifest]] = None) -> None:
     """Process a specific tree type for a given cluster."""
-    tree_path = f'{trees_dir}/{cluster_name}_ncbi_trimmed.nw'
     output_paths = setup_output_paths(base_output_dir, cluster_name, tree_type)
 
     # Process and save the tree
-    process_and_save_tree(cluster_name, tree_type, tree_path, annotation_dict, output_paths,
-                          align_labels=False, align_boxes=True,
-                          logging_level=logging.INFO)
+    selected_clades = process_and_save_tree(cluster_name, tree_type, base_tree, output_paths, options,
+                                            align_labels=False, align_boxes=True,
+                                            logging_level=logging.INFO, bipartitions=bipartitions,
+                                            manifests=manifests)
 
-    # Concatenate clades tables
-    concatenate_clades_tables(output_paths['output_dir'], output_paths['biggest_non_intersecting_clades_all'])
+    if not options['render_plots'] or not start_stage(manifests, 'plots'):
+        return
+    if selected_clades is None:
+        # The threshold tables are up to date; plot the clades of the saved selection profile
+        selected_clades = expand_selection_profile(load_selection_profile(output_paths['selection_profile']),
+                                                   options['thresholds'])
+    if selected_clades.empty:
+        logging.warning(f"No selected clades to plot for {tree_type} cluster {cluster_name}")
+        record_stage(manifests, 'plots', [])
+        return
 
-    # Generate plots for the tree type
-    generate_plots(output_paths, tree_type)
+    # Generate plots for the tree type; matplotlib and seaborn are only imported when plotting
+    from plotting import generate_plots
+
+    generate_plots(output_paths, tree_type, options['thresholds'], selected_clades)
+    record_stage(manifests, 'plots', sorted(glob.glob(f"{output_paths['output_dir']}/figures/*_{tree_type}.png")))
+
+
+def tree_plot_file(output_paths: Dict[str, str], options: Dict[str, Any]) -> str:
+    """Return the path of the tree plot written by the configured backend."""
+    return f"{output_paths['tree_plot']}.{TREE_PLOT_BACKENDS[options['tree_plot_backend']][1]}"
+
+
+def annotation_digest(paths: Dict[str, str], options: Dict[str, Any]) -> str:
+    """Return the digest of the annotation table the trees are annotated from, cached for the whole run.
+
+    The annotation store is built from annotation_path_id, so that table stands for the store as well. The
+    digest is computed once before the cluster jobs, by the annotation_digest rule of the Snakefile or by
+    process_clusters, and the jobs only read it back.
+    """
+    matching = options['annotation_matching']
+    annotation_path = paths['annotation_path'] if matching == 'prefix' else paths['annotation_path_id']
+    return cached_file_digest(annotation_path, digest_cache_dir(paths['base_output_dir']))
+
+
+def tree_fingerprint(paths: Dict[str, str], cluster_name: str, options: Dict[str, Any]) -> str:
+    """Return a digest of what the annotated base tree is built from: tree file, annotation table, matching and code."""
+    return fingerprint(file_digest(get_tree_path(paths['trees_dir'], cluster_name)),
+                       annotation_digest(paths, options), options['annotation_matching'],
+                       code_digest('tree_utils', 'compact_tree', 'taxonomy_codes', 'annotation_store'))
+
+
+def stage_manifests(output_dir: str, tree_key: str, tree_type: str,
+                    options: Dict[str, Any]) -> Dict[str, StageManifest]:
+    """Return the manifests of the stages run for a tree type; each is keyed on the stages whose outputs it uses."""
+    thresholds = options['thresholds']
+    statistics = StageManifest(output_dir, 'clade_statistics', tree=tree_key, tree_type=tree_type,
+                               compact=options['compact_clade_table'],
+                               code=code_digest('clade_analysis', 'compact_tree'))
+    tables = StageManifest(output_dir, 'threshold_tables', clade_statistics=statistics.key, thresholds=thresholds,
+                           selected_members=options['selected_clade_members'],
+                           threshold_tables=options['write_threshold_tables'], code=code_digest('clade_analysis'))
+    manifests = [statistics, tables]
+    if options['render_plots']:
+        manifests.append(StageManifest(output_dir, 'plots', threshold_tables=tables.key, thresholds=thresholds,
+                                       code=code_digest('plotting', 'colours')))
+    if options['render_tree'] and options['defer_tree_plot']:
+        # The tree plot itself is rendered by render_cluster, with manifests of its own
+        manifests.append(StageManifest(output_dir, 'annotated_tree', clade_statistics=statistics.key,
+                                       code=code_digest('tree_utils', 'compact_tree')))
+    elif options['render_tree'] and options['tree_plot_mode'] == 'summary':
+        # The summary collapses the clades selected in the threshold tables
+        manifests.append(tree_plot_manifest(output_dir, options, threshold_tables=tables.key))
+    elif options['render_tree']:
+        manifests.append(tree_plot_manifest(output_dir, options, clade_statistics=statistics.key))
+    return {manifest.stage: manifest for manifest in manifests}
+
+
+def tree_plot_manifest(output_dir: str, options: Dict[str, Any], **inputs: str) -> StageManifest:
+    """Return the manifest of the tree plot rendered from the given inputs with the configured mode and backend."""
+    renderer = TREE_PLOT_BACKENDS[options['tree_plot_backend']][0]
+    if options['tree_plot_mode'] == 'summary':
+        return StageManifest(output_dir, 'tree_plot', mode='summary', summary_threshold=options['summary_threshold'],
+                             renderer=renderer, code=code_digest(renderer, 'colours', 'tree_utils'), **inputs)
+    return StageManifest(output_dir, 'tree_plot', mode='full', thresholds=options['thresholds'], renderer=renderer,
+                         code=code_digest(renderer, 'colours'), **inputs)
+
+
+def start_stage(manifests: Optional[Dict[str, StageManifest]], stage: str) -> bool:
+    """Return whether a stage has to run; if it does, its manifest is removed until record_stage is called."""
+    if manifests is None:
+        return True
+    if manifests[stage].is_current():
+        logging.info(f"Outputs of stage {stage} are up to date, skipping")
+        return False
+    manifests[stage].invalidate()
+    return True
+
+
+def record_stage(manifests: Optional[Dict[str, StageManifest]], stage: str, outputs: List[str]) -> None:
+    """Save the manifest of a completed stage (in incremental mode)."""
+    if manifests is not None:
+        manifests[stage].record(outputs)
 
 
 def concatenate_logs(output_dir: str, final_log_file: str, cluster_names: list[str]) -> None:
@@ -213,32 +536,140 @@ def concatenate_logs(output_dir: str, final_log_file: str, cluster_names: list[s
     logging.info(f"Final log concatenated and saved to {final_log_file}")
 
 
-@time_it(message="Main processing function")
-def main(config_file: str, cluster_name: str) -> None:
-    """Main function to process a single cluster."""
-    with open(config_file, 'r') as file:
-        config = yaml.safe_load(file)
+@time_it(message="load annotations")
+def load_annotation_codes(paths: Dict[str, str], leaf_names: List[str], matching: str = 'exact') -> AnnotationCodes:
+    """Load the annotations as taxonomy codes, only for the cluster's leaves if an annotation store is set.
 
-    # Format the paths in the config file
-    config = format_paths(config)
+    For 'prefix' matching the annotation file with partial protein IDs is read instead; row order matters
+    there (the first matching ID wins), so it is always read from the TSV.
+    """
+    if matching != 'prefix' and paths['annotation_store']:
+        if os.path.exists(paths['annotation_store']):
+            return AnnotationCodes.from_dataframe(fetch_annotations(paths['annotation_store'], leaf_names))
+        logging.warning(f"Annotation store {paths['annotation_store']} does not exist; reading the annotation "
+                        f"table instead. Build the store with annotation_store.py to speed this up.")
+    return read_annotation_codes(paths, matching)
 
-    # Setup paths from config
-    paths = setup_paths(config)
 
-    annotations = load_annotations(paths['annotation_path_id'])
+def read_annotation_codes(paths: Dict[str, str], matching: str = 'exact') -> AnnotationCodes:
+    """Read the whole annotation table as taxonomy codes, with partial protein IDs for 'prefix' matching."""
+    annotations = load_annotations(paths['annotation_path'] if matching == 'prefix' else paths['annotation_path_id'])
 
     if annotations.duplicated(subset='protein_id').any():
         logging.info("Duplicate protein IDs found. Removing duplicates.")
         # print("Duplicate protein IDs found. Removing duplicates.")
         annotations = annotations.drop_duplicates(subset='protein_id')
 
-    annotation_dict = annotations.set_index('protein_id').to_dict('index')
+    return AnnotationCodes.from_dataframe(annotations)
+
+
+def process_cluster_job(cluster_name: str, tree_types: List[str], paths: Dict[str, str], options: Dict[str, Any],
+                        annotations: Optional[AnnotationCodes] = None, render_only: bool = False) -> None:
+    """Process (or only render) a cluster in a batch worker, writing out its queued log records before the worker
+    exits."""
+    try:
+        if render_only:
+            render_cluster(cluster_name, tree_types, paths, options)
+        else:
+            process_cluster(cluster_name, tree_types, paths, options, annotations)
+    finally:
+        stop_logging()
+
+
+@time_it(message="batch of clusters")
+def process_clusters(cluster_names: List[str], tree_types: List[str], paths: Dict[str, str],
+                     options: Dict[str, Any], workers: int, timeout: Optional[float] = None,
+                     render_only: bool = False) -> Dict[str, str]:
+    """Process clusters (or only render their deferred tree plots) in up to ``workers`` parallel processes and
+    return the outcome of each cluster.
+
+    The annotation table is read once, before the worker processes are forked, so that they share its
+    arrays copy-on-write instead of each loading it. Every cluster runs in a process of its own: a cluster
+    that fails, or is still running after ``timeout`` seconds and is killed, does not affect the others.
+    """
+    annotations = None
+    if not render_only:
+        annotations = read_annotation_codes(paths, options['annotation_matching'])
+        # Build the protein ID hash table here rather than once in every worker
+        annotations.build_index()
+        if options['incremental']:
+            # Hash the annotation table here rather than in every worker of the first run
+            annotation_digest(paths, options)
+
+    # Import the rendering modules once here rather than in every worker
+    if options['render_tree'] and (render_only or not options['defer_tree_plot']):
+        importlib.import_module(TREE_PLOT_BACKENDS[options['tree_plot_backend']][0])
+    if options['render_plots'] and not render_only:
+        importlib.import_module('plotting')
+
+    context = multiprocessing.get_context('fork')
+    pending = list(cluster_names)
+    running: Dict[Any, Tuple[str, float]] = {}  # Worker process -> (cluster name, start time)
+    outcomes: Dict[str, str] = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            cluster_name = pending.pop(0)
+            process = context.Process(target=process_cluster_job, name=cluster_name,
+                                      args=(cluster_name, tree_types, paths, options, annotations, render_only))
+            process.start()
+            running[process] = (cluster_name, monotonic())
+
+        # Sleep until a worker exits or the oldest one reaches its timeout
+        first_deadline = min(started for _, started in running.values()) + timeout if timeout else None
+        wait([process.sentinel for process in running],
+             None if first_deadline is None else max(0.0, first_deadline - monotonic()))
+
+        for process, (cluster_name, started) in list(running.items()):
+            if process.is_alive():
+                if timeout is None or monotonic() - started < timeout:
+                    continue
+                process.kill()
+                outcomes[cluster_name] = f'timed out after {timeout} seconds'
+            elif process.exitcode == 0:
+                outcomes[cluster_name] = 'completed'
+            else:
+                outcomes[cluster_name] = f'failed with exit code {process.exitcode}'
+            process.join()
+            del running[process]
+            log = logging.info if outcomes[cluster_name] == 'completed' else logging.error
+            log(f"Cluster {cluster_name} {outcomes[cluster_name]} ({len(outcomes)}/{len(cluster_names)})")
+
+    return outcomes
+
+
+def load_config(config_file: str) -> Dict[str, Any]:
+    """Load the YAML configuration file with its paths formatted."""
+    with open(config_file, 'r') as file:
+        config = yaml.safe_load(file)
+
+    # Format the paths in the config file
+    return format_paths(config)
+
+
+@time_it(message="Main processing function")
+def main(config_file: str, cluster_name: str, tree_type: Optional[str] = None, stats_only: bool = False,
+         render_only: bool = False) -> None:
+    """Main function to process a single cluster, for one tree type or for all tree types in the config.
+
+    With ``render_only``, only the deferred tree plots are rendered from the saved annotated trees.
+    """
+    config = load_config(config_file)
+
+    # Setup paths from config
+    paths = setup_paths(config)
+
+    options = setup_options(config, stats_only)
 
     # Add both rooted and unrooted tree types
-    tree_types = config.get('tree_types', ['rooted', 'unrooted', 'midpoint'])
+    tree_types = [tree_type] if tree_type else config.get('tree_types', TREE_TYPES)
+
+    if render_only:
+        render_cluster(cluster_name, tree_types, paths, options)
+        logging.info(f"Cluster {cluster_name} tree plots rendered")
+        return
 
     # Process each tree type for the specified cluster
-    process_cluster(cluster_name, tree_types, paths, annotation_dict)
+    process_cluster(cluster_name, tree_types, paths, options)
     logging.info(f"Cluster {cluster_name} analysis completed")
 
     # final_log_file = os.path.join(paths['base_output_dir'], 'final_log_tree_analysis.log')
@@ -246,16 +677,60 @@ def main(config_file: str, cluster_name: str) -> None:
     # logging.info(f"Final log file created at {final_log_file}")
 
 
-if __name__ == "__main__":
-    import matplotlib
-    matplotlib.use('Agg')
+def main_batch(config_file: str, clusters_file: str, workers: int, timeout: Optional[float] = None,
+               tree_type: Optional[str] = None, stats_only: bool = False, render_only: bool = False) -> bool:
+    """Process all clusters listed in a file with a pool of worker processes; return whether all completed."""
+    if workers < 1:
+        raise ValueError(f"The number of workers must be at least 1, not {workers}")
+    config = load_config(config_file)
+    paths = setup_paths(config)
+    options = setup_options(config, stats_only)
+    tree_types = [tree_type] if tree_type else config.get('tree_types', TREE_TYPES)
+
+    cluster_names = read_cluster_names_from_file(clusters_file)
+    if paths['cluster_index']:
+        # Start the largest clusters first, so that they do not end up running alone at the end of the batch
+        cluster_names = largest_first(load_cluster_index(paths['cluster_index'], paths['trees_dir'], cluster_names),
+                                      cluster_names)
+    logging.info(f"Processing {len(cluster_names)} clusters with {workers} workers")
+    outcomes = process_clusters(cluster_names, tree_types, paths, options, workers, timeout, render_only)
 
+    failed = [cluster_name for cluster_name, outcome in outcomes.items() if outcome != 'completed']
+    if failed:
+        logging.error(f"{len(failed)} of {len(cluster_names)} clusters did not complete: {', '.join(failed)}")
+    return not failed
+
+
+if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run tree analysis for a specific protein cluster.")
     parser.add_argument("-c", "--config", required=True, help="Path to the YAML configuration file.")
-    parser.add_argument("--cluster", required=True, help="Protein cluster name to process.")
-    # parser.add_argument("--tree_type", required=True, help="Rooting tree type to process.")
+    clusters = parser.add_mutually_exclusive_group(required=True)
+    clusters.add_argument("--cluster", help="Protein cluster name to process.")
+    clusters.add_argument("--clusters_file",
+                          help="File with one cluster name per line; all of them are processed in one batch.")
+    parser.add_argument("--tree_type", choices=TREE_TYPES,
+                        help="Rooting tree type to process; all tree types in the config if omitted.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of clusters processed in parallel with --clusters_file (default: all CPUs).")
+    parser.add_argument("--timeout", type=float,
+                        help="Seconds after which a cluster of the batch is stopped (default: no limit).")
+    stages = parser.add_mutually_exclusive_group()
+    stages.add_argument("--stats-only", action="store_true",
+                        help="Only write the clade tables, without the plots and the tree plot.")
+    stages.add_argument("--render-only", action="store_true",
+                        help="Only render the tree plots deferred by render: deferred, from the saved annotated trees.")
     args = parser.parse_args()
-
-    main(config_file=args.config, cluster_name=args.cluster)
+    if args.workers < 1:
+        parser.error(f"--workers must be at least 1, not {args.workers}")
+
+    if args.clusters_file:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s\t%(levelname)s\t%(message)s')
+        if not main_batch(config_file=args.config, clusters_file=args.clusters_file, workers=args.workers,
+                          timeout=args.timeout, tree_type=args.tree_type, stats_only=args.stats_only,
+                          render_only=args.render_only):
+            sys.exit(1)
+    else:
+        main(config_file=args.config, cluster_name=args.cluster, tree_type=args.tree_type,
+             stats_only=args.stats_only, render_only=args.render_only)
 
     # compare_clusters(cluster_names=cluster_names, base_output_dir=paths['base_output_dir'], tree_types=tree_types)
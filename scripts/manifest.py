@@ -0,0 +1,117 @@
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+from typing import Any, List
+
+MANIFEST_DIR = 'manifests'
+
+
+def fingerprint(*parts: Any) -> str:
+    """Return the SHA-256 digest of JSON-serializable parts, such as parameters and other digests."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """Return the SHA-256 digest of a file's content."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def digest_cache_dir(base_output_dir: str) -> str:
+    """Return the directory where cached_file_digest keeps the digests of the large inputs of a run."""
+    return os.path.join(base_output_dir, MANIFEST_DIR, 'file_digests')
+
+
+def digest_cache_path(path: str, cache_dir: str) -> str:
+    """Return the file in which cached_file_digest caches the digest of ``path``."""
+    return os.path.join(cache_dir, f'{fingerprint(os.path.abspath(path))}.json')
+
+
+def cached_file_digest(path: str, cache_dir: str) -> str:
+    """Return file_digest of a large input, reusing the digest cached in ``cache_dir`` while the file's size
+    and modification time are unchanged."""
+    stat = os.stat(path)
+    cache_path = digest_cache_path(path, cache_dir)
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['sha256']
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    digest = file_digest(path)
+    write_json(cache_path, {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                            'sha256': digest})
+    return digest
+
+
+def code_digest(*module_names: str) -> str:
+    """Return a digest of the source files of the given modules, without importing them."""
+    return fingerprint(*[file_digest(module_origin(name)) for name in module_names])
+
+
+def module_origin(module_name: str) -> str:
+    """Return the path of a module's source file."""
+    spec = importlib.util.find_spec(module_name)
+    if spec is None or spec.origin is None:
+        raise ImportError(f"No source file found for module {module_name}")
+    return spec.origin
+
+
+def write_json(path: str, data: Any) -> None:
+    """Write JSON next to its final path and move it into place, so that concurrent readers never see a partial
+    file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class StageManifest:
+    """Inputs, code and parameters a pipeline stage ran with, saved as {output_dir}/manifests/{stage}.json.
+
+    ``components`` map names to digests of inputs and code, or to parameter values; a stage whose manifest
+    has the same components, and whose recorded outputs all exist, does not need to run again. The
+    manifest's ``key`` stands for the stage's outputs in the manifests of the stages that use them.
+    """
+
+    def __init__(self, output_dir: str, stage: str, **components: Any) -> None:
+        self.stage = stage
+        self.path = os.path.join(output_dir, MANIFEST_DIR, f'{stage}.json')
+        self.components = components
+        self.key = fingerprint(stage, components)
+
+    def is_current(self) -> bool:
+        """Return whether the stage last completed with the same components and its outputs still exist."""
+        try:
+            with open(self.path) as f:
+                recorded = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        return recorded.get('key') == self.key and all(os.path.exists(path) for path in recorded.get('outputs', []))
+
+    def invalidate(self) -> None:
+        """Remove the manifest before the stage rewrites its outputs, so that an interrupted run is redone."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def record(self, outputs: List[str]) -> None:
+        """Save the manifest once the stage has written its outputs."""
+        write_json(self.path, {'stage': self.stage, 'key': self.key, 'components': self.components,
+                               'outputs': outputs})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hash a large input once and cache its digest for the cluster jobs.")
+    parser.add_argument("--file", required=True, help="Path to the file to hash.")
+    parser.add_argument("--cache_dir", required=True, help="Directory of the cached digests.")
+    args = parser.parse_args()
+
+    print(cached_file_digest(args.file, args.cache_dir))
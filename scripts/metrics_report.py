@@ -0,0 +1,104 @@
+import argparse
+import glob
+import os
+from typing import Optional
+
+import pandas as pd
+
+
+def load_metrics(metrics_dir: str) -> pd.DataFrame:
+    """Load the metrics records written by time_it for all cluster jobs, of all runs.
+
+    Records written before they had a run_id count as a single run per file.
+    """
+    frames = []
+    for path in sorted(glob.glob(os.path.join(metrics_dir, '*.jsonl'))):
+        if os.path.getsize(path) == 0:
+            continue
+        frame = pd.read_json(path, lines=True)
+        if 'run_id' not in frame.columns:
+            frame = frame.assign(run_id=path, run_started='')
+        frames.append(frame)
+    if not frames:
+        raise FileNotFoundError(f"No metrics records found in {metrics_dir}")
+    return pd.concat(frames, ignore_index=True)
+
+
+def latest_runs(metrics: pd.DataFrame) -> pd.DataFrame:
+    """Keep the records of the latest run that did the work of each cluster, tree type and kind of job.
+
+    Every job appends a run to its metrics file, so a rerun that skipped all the stages of a tree type
+    (incremental: true) would otherwise replace the run that did them, and files of jobs grouped differently
+    in an earlier run would be counted twice. A run did the work of the tree types it has records of; the
+    records of a run that did none are dropped.
+    """
+    runs = metrics.groupby('run_id').agg(
+        cluster=('cluster', 'first'),
+        run_started=('run_started', 'first'),
+        render=('stage', lambda stages: bool((stages == 'render_cluster').any())),
+    )
+    worked = metrics.dropna(subset=['tree_type'])[['run_id', 'tree_type']].drop_duplicates().join(runs, on='run_id')
+    latest = worked.sort_values('run_started').groupby(['cluster', 'render', 'tree_type'])['run_id'].last()
+    return metrics[metrics['run_id'].isin(latest)].reset_index(drop=True)
+
+
+def summarize_stages(metrics: pd.DataFrame) -> pd.DataFrame:
+    """Return the calls, total and largest wall and CPU times and the memory peaks of each stage and tree type.
+
+    The time of a stage includes the stages it calls, e.g. generate_plots is part of process_tree_type.
+    """
+    metrics = metrics.assign(tree_type=metrics['tree_type'].fillna('-'))
+    summary = metrics.groupby(['stage', 'tree_type']).agg(
+        calls=('wall_time_s', 'size'),
+        total_wall_time_s=('wall_time_s', 'sum'),
+        mean_wall_time_s=('wall_time_s', 'mean'),
+        max_wall_time_s=('wall_time_s', 'max'),
+        total_cpu_time_s=('cpu_time_s', 'sum'),
+        max_rss_growth_mb=('max_rss_growth_mb', 'max'),
+        max_traced_peak_mb=('traced_peak_mb', 'max'),
+    ).reset_index()
+    # Stages are nested (process_cluster contains all the others), so compare each with the time of whole jobs
+    job_time = metrics.loc[metrics['stage'] == 'process_cluster', 'wall_time_s'].sum()
+    summary['share_of_job_time'] = summary['total_wall_time_s'] / job_time if job_time else float('nan')
+    return summary.sort_values('total_wall_time_s', ascending=False).round(3)
+
+
+def summarize_clusters(metrics: pd.DataFrame, top: Optional[int] = None) -> pd.DataFrame:
+    """Return the wall and CPU time and peak RSS of each cluster, summed over its jobs, most expensive first."""
+    jobs = metrics[metrics['stage'] == 'process_cluster']
+    summary = jobs.groupby('cluster').agg(
+        leaves=('leaves', 'max'),
+        jobs=('wall_time_s', 'size'),
+        wall_time_s=('wall_time_s', 'sum'),
+        cpu_time_s=('cpu_time_s', 'sum'),
+        max_rss_mb=('max_rss_mb', 'max'),
+    ).reset_index().sort_values('wall_time_s', ascending=False)
+    return summary.head(top) if top else summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the per-stage metrics of the cluster jobs of a run.")
+    parser.add_argument("--metrics_dir", required=True, help="Directory with the metrics .jsonl files of the jobs.")
+    parser.add_argument("--top", type=int, default=20, help="Number of most expensive clusters to show.")
+    parser.add_argument("--output_dir", help="Directory to save the stage and cluster summaries to as TSV files.")
+    parser.add_argument("--all_runs", action="store_true",
+                        help="Summarize the records of all runs instead of the latest run that did each job's work.")
+    args = parser.parse_args()
+
+    records = load_metrics(args.metrics_dir)
+    if not args.all_runs:
+        records = latest_runs(records)
+    stages = summarize_stages(records)
+    clusters = summarize_clusters(records)
+
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(f"{records['cluster'].nunique()} clusters, {records['run_id'].nunique()} runs, {len(records)} records\n")
+        print("Stages by total wall time:")
+        print(stages.to_string(index=False))
+        print(f"\nMost expensive clusters (top {args.top}):")
+        print(clusters.head(args.top).to_string(index=False))
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        stages.to_csv(os.path.join(args.output_dir, 'metrics_stages.tsv'), sep='\t', index=False)
+        clusters.to_csv(os.path.join(args.output_dir, 'metrics_clusters.tsv'), sep='\t', index=False)
@@ -1,11 +1,17 @@
 import logging
 import os
 
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
 import matplotlib
-from colours import source_colors, superkingdom_colors, phylum_colors, crassvirales_color
+import numpy as np
+from colours import COLLAPSED_COLORS, TAXONOMY_BOX_COLORS, source_colors, superkingdom_colors, phylum_colors, \
+    crassvirales_color
 from ete3 import Tree, TreeStyle, TextFace, faces
 
-from tree_utils import print_node_features
+from clade_analysis import DEFAULT_THRESHOLDS
+from compact_tree import CompactTree
+from tree_utils import print_node_features, summarize_compact_tree
 from utils import time_it
 
 # Set environment variable for non-interactive backend
@@ -13,9 +19,64 @@ os.environ['QT_QPA_PLATFORM'] = 'offscreen'
 matplotlib.use('Agg')  # Force matplotlib to use a non-interactive backend
 
 
-def layout(node: Tree, align_labels: bool = False, align_boxes: bool = False) -> None:
-    WIDTH = 20
+# Side of the taxonomy and clade boxes, and font size of the node names
+WIDTH = 20
+
+# Colours of a node's taxonomy boxes (one per annotated feature) and of its clade boxes (one per threshold)
+NodeColors = Tuple[Tuple[str, ...], Tuple[str, ...]]
+
+
+class SharedRectFace(faces.RectFace):
+    """RectFace that can be added to any number of nodes.
+
+    ete3 places a RectFace by reparenting the single graphics item it made for the face, and aligned faces
+    of all nodes are made before any is placed; this face instead hands out a new item every time.
+    """
+
+    def update_items(self) -> None:
+        pass
+
+    @property
+    def item(self) -> Any:
+        return faces._RectItem(self.width, self.height, self.bgcolor, self.fgcolor, label=self.label)
+
+
+# Faces depend only on their colour and size, so each distinct one is made once and shared by all nodes
+_rect_faces: Dict[Tuple[str, int], SharedRectFace] = {}
+_text_faces: Dict[Tuple[str, str, int], TextFace] = {}
+
 
+def rect_face(color: str, size: int = WIDTH) -> SharedRectFace:
+    """Return the shared square face of the given colour and size."""
+    face = _rect_faces.get((color, size))
+    if face is None:
+        face = _rect_faces[color, size] = SharedRectFace(width=size, height=size, fgcolor=color, bgcolor=color)
+    return face
+
+
+def text_face(text: str, fgcolor: str = 'black', fsize: int = 10) -> TextFace:
+    """Return the shared face of a fixed text, such as the spacers between box columns."""
+    face = _text_faces.get((text, fgcolor, fsize))
+    if face is None:
+        face = _text_faces[text, fgcolor, fsize] = TextFace(text, fgcolor=fgcolor, fsize=fsize)
+    return face
+
+
+def node_colors(node: Tree, thresholds: List[float] = DEFAULT_THRESHOLDS) -> NodeColors:
+    """Return the colours of the node's taxonomy and clade boxes."""
+    taxonomy = tuple(colors.get(getattr(node, feature), default) for feature, colors, default in TAXONOMY_BOX_COLORS
+                     if feature in node.features)
+    clades = tuple('black' if getattr(node, f'clade_{threshold}', False) else 'white' for threshold in thresholds)
+    return taxonomy, clades
+
+
+def precompute_node_colors(tree: Tree, thresholds: List[float] = DEFAULT_THRESHOLDS) -> Dict[Tree, NodeColors]:
+    """Return the box colours of every node, so that the layout function only has to look them up."""
+    return {node: node_colors(node, thresholds) for node in tree.traverse()}
+
+
+def layout(node: Tree, align_labels: bool = False, align_boxes: bool = False,
+           thresholds: List[float] = DEFAULT_THRESHOLDS, colors: Optional[Dict[Tree, NodeColors]] = None) -> None:
     label_position = 'aligned' if align_labels else 'branch-right'
 
     if not hasattr(node, 'label_added') or not node.label_added:
@@ -33,55 +94,26 @@ def layout(node: Tree, align_labels: bool = False, align_boxes: bool = False) ->
 
         node.label_added = True
 
+    taxonomy_colors, clade_colors = colors[node] if colors is not None else node_colors(node, thresholds)
+
     box_position = 'aligned' if align_boxes else 'branch-right'
     column_offset = 1
 
-    if 'source' in node.features:
-        source = node.source
-        color = source_colors.get(source, 'gray')
-        color_face = faces.RectFace(width=WIDTH, height=WIDTH, fgcolor=color, bgcolor=color)
-        node.add_face(color_face, column=column_offset, position=box_position)
-        column_offset += 1
-
-    if 'superkingdom' in node.features:
-        superkingdom = node.superkingdom
-        color = superkingdom_colors.get(superkingdom, superkingdom_colors['Other'])
-        color_face = faces.RectFace(width=WIDTH, height=WIDTH, fgcolor=color, bgcolor=color)
-        node.add_face(color_face, column=column_offset, position=box_position)
-        column_offset += 1
-
-    if 'phylum' in node.features:
-        phylum = node.phylum
-        color = phylum_colors.get(phylum, 'gray')
-        color_face = faces.RectFace(width=WIDTH, height=WIDTH, fgcolor=color, bgcolor=color)
-        node.add_face(color_face, column=column_offset, position=box_position)
-        column_offset += 1
-
-    if 'order' in node.features:
-        order = node.order
-        color = crassvirales_color if order == 'Crassvirales' else 'gray'
-        color_face = faces.RectFace(width=WIDTH, height=WIDTH, fgcolor=color, bgcolor=color)
-        node.add_face(color_face, column=column_offset, position=box_position)
+    for color in taxonomy_colors:
+        node.add_face(rect_face(color), column=column_offset, position=box_position)
         column_offset += 1
 
     # Add a space before the black/white boxes
-    spacer_face = TextFace("  ")  # Add some space
-    node.add_face(spacer_face, column=column_offset, position='aligned')
+    node.add_face(text_face("  "), column=column_offset, position='aligned')
     column_offset += 1
 
     # Add black/white boxes for clade features for each threshold
-    for i, threshold in enumerate(range(0, 101, 10)):
-        clade_key = f'clade_{threshold}'
-        if hasattr(node, clade_key) and getattr(node, clade_key):
-            color_face = faces.RectFace(width=WIDTH, height=WIDTH, fgcolor='black', bgcolor='black')
-        else:
-            color_face = faces.RectFace(width=WIDTH, height=WIDTH, fgcolor='white', bgcolor='white')
-        node.add_face(color_face, column=column_offset, position='aligned')
+    for color in clade_colors:
+        node.add_face(rect_face(color), column=column_offset, position='aligned')
         column_offset += 1
 
     # Add a space after the black/white boxes (optional, if needed for additional annotations)
-    spacer_face_end = TextFace("  ")  # Add some space
-    node.add_face(spacer_face_end, column=column_offset, position='aligned')
+    node.add_face(text_face("  "), column=column_offset, position='aligned')
 
 
 def add_legend(ts: TreeStyle) -> None:
@@ -155,13 +187,15 @@ def add_legend(ts: TreeStyle) -> None:
 
 @time_it("Saving tree plot")
 def save_tree_plot(tree: Tree, output_path: str, align_labels: bool = False, align_boxes: bool = False,
-                   layout_fn=None) -> None:
+                   layout_fn=None, thresholds: List[float] = DEFAULT_THRESHOLDS) -> None:
     """Save the tree plot to a file."""
     ts = TreeStyle()
 
     if layout_fn is None:
+        colors = precompute_node_colors(tree, thresholds)
+
         def layout_fn(n):
-            return layout(n, align_labels, align_boxes)
+            return layout(n, align_labels, align_boxes, thresholds, colors)
         # layout_fn = lambda n: layout(n, align_labels, align_boxes)
 
     ts.layout_fn = layout_fn
@@ -179,3 +213,60 @@ def save_tree_plot(tree: Tree, output_path: str, align_labels: bool = False, ali
     pdf_output_path = f"{output_path}.pdf"
     tree.render(pdf_output_path, tree_style=ts, dpi=600)
     logging.info(f"Tree plot saved to {pdf_output_path}")
+
+
+def summary_layout(node: Tree) -> None:
+    """Draw a collapsed node of a summary tree as a box sized by its proteins and annotated with its counts; draw
+    its taxonomy boxes next to a leaf."""
+    if getattr(node, 'layout_done', False):
+        return
+    node.layout_done = True
+
+    collapsed = getattr(node, 'collapsed', None)
+    if collapsed is None and not node.is_leaf():
+        return
+
+    node.add_face(TextFace(node.name, fgcolor='black', fsize=WIDTH), column=0, position='branch-right')
+    if collapsed is None:
+        for column, color in enumerate(node_colors(node, [])[0], start=1):
+            node.add_face(rect_face(color), column=column, position='branch-right')
+        return
+
+    # The box grows with the order of magnitude of the clade size, so that large clades stand out
+    width = WIDTH * (1 + int(np.log10(max(node.total_proteins, 1))))
+    node.add_face(SharedRectFace(width=width, height=WIDTH, fgcolor='black', bgcolor=COLLAPSED_COLORS[collapsed]),
+                  column=1, position='branch-right')
+    counts_face = TextFace(f" {node.total_proteins} proteins, Crassvirales ratio: "
+                           f"{node.ratio_crass_to_total * 100:.2f}%", fgcolor='black', fsize=15)
+    node.add_face(counts_face, column=2, position='branch-right')
+
+
+@time_it("Saving summary tree plot")
+def save_summary_tree_plot(tree: CompactTree, clade_roots: Iterable[int], output_path: str,
+                           threshold: float) -> None:
+    """Save a plot of the tree with the largest non-intersecting clades at the threshold collapsed."""
+    compact_summary = summarize_compact_tree(tree, clade_roots)
+    logging.info(f"Summary tree at {threshold}% has {len(compact_summary.leaf_indices)} leaves instead of "
+                 f"{len(tree.leaf_indices)}")
+    summary = compact_summary.to_ete()
+
+    ts = TreeStyle()
+    ts.layout_fn = summary_layout
+    ts.show_leaf_name = False
+    ts.mode = 'r'
+    ts.scale = 100
+    ts.title.add_face(TextFace(f"Largest non-intersecting clades at a Crassvirales ratio of {threshold}% collapsed",
+                               fsize=WIDTH), column=0)
+
+    add_legend(ts)
+    ts.legend.add_face(TextFace(" "), column=0)
+    ts.legend.add_face(TextFace("Collapsed", fsize=21, bold=True), column=0)
+    ts.legend.add_face(TextFace(" "), column=1)
+    for kind, label in (('clade', 'Selected clade'), ('other', 'Other proteins')):
+        ts.legend.add_face(faces.RectFace(width=20, height=20, fgcolor='black', bgcolor=COLLAPSED_COLORS[kind]),
+                           column=0)
+        ts.legend.add_face(TextFace(label, fsize=20), column=1)
+
+    pdf_output_path = f"{output_path}.pdf"
+    summary.render(pdf_output_path, tree_style=ts, dpi=600)
+    logging.info(f"Summary tree plot saved to {pdf_output_path}")
@@ -1,23 +1,21 @@
 import os
-from typing import Dict
+from typing import Dict, List, Optional
 
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
 
+from clade_analysis import DEFAULT_THRESHOLDS, expand_selection_profile, load_selection_profile
 from colours import superkingdom_colors, phylum_colors, crassvirales_color
 from utils import time_it
 
 
-def plot_bacterial_ratios_vs_threshold(concatenated_table: str, output_dir: str, tree_type: str) -> None:
+def plot_bacterial_ratios_vs_threshold(df: pd.DataFrame, output_dir: str, tree_type: str) -> None:
     """Plot bacterial ratios vs thresholds and save the figure."""
     # Create the figures directory if it doesn't exist
     figures_dir = os.path.join(output_dir, 'figures')
     os.makedirs(figures_dir, exist_ok=True)
 
-    # Load the concatenated table
-    df = pd.read_csv(concatenated_table, sep='\t')
-
     # Define the dictionary of colors for the lines
     colors: Dict[str, str] = {
         'ratio_Bacteroidetes_to_total': phylum_colors['Bacteroidetes'],  # Blue
@@ -52,16 +50,13 @@ def plot_bacterial_ratios_vs_threshold(concatenated_table: str, output_dir: str,
     # print(f"Plot saved to {output_file}")
 
 
-def plot_crassvirales_bacterial_viral_ratios_vs_threshold(concatenated_table: str, output_dir: str,
+def plot_crassvirales_bacterial_viral_ratios_vs_threshold(df: pd.DataFrame, output_dir: str,
                                                           tree_type: str) -> None:
     """Plot Crassvirales, bacterial, and viral ratios vs thresholds and save the figure."""
     # Create the figures directory if it doesn't exist
     figures_dir = os.path.join(output_dir, 'figures')
     os.makedirs(figures_dir, exist_ok=True)
 
-    # Load the concatenated table
-    df = pd.read_csv(concatenated_table, sep='\t')
-
     # Define the dictionary of colors for the lines
     colors: Dict[str, str] = {
         'crassvirales_ratio': crassvirales_color,  # Blue
@@ -93,13 +88,11 @@ def plot_crassvirales_bacterial_viral_ratios_vs_threshold(concatenated_table: st
     # print(f"Plot saved to {output_file}")
 
 
-def plot_number_of_clades_vs_threshold(concatenated_table: str, output_dir: str, tree_type: str) -> None:
+def plot_number_of_clades_vs_threshold(df: pd.DataFrame, output_dir: str, tree_type: str) -> None:
     """Plot the number of clades found vs thresholds and save the figure."""
     figures_dir = os.path.join(output_dir, 'figures')
     os.makedirs(figures_dir, exist_ok=True)
 
-    df = pd.read_csv(concatenated_table, sep='\t')
-
     # Count the number of clades for each threshold
     clade_counts = df.groupby('threshold').size().reset_index(name='Number of Clades')
 
@@ -117,14 +110,11 @@ def plot_number_of_clades_vs_threshold(concatenated_table: str, output_dir: str,
     # print(f"Plot saved to {output_file}")
 
 
-def plot_number_of_members_boxplot(concatenated_table: str, output_dir: str, tree_type: str) -> None:
+def plot_number_of_members_boxplot(df: pd.DataFrame, output_dir: str, tree_type: str) -> None:
     """Plot boxplots of number_of_members vs thresholds and save the figure."""
     figures_dir = os.path.join(output_dir, 'figures')
     os.makedirs(figures_dir, exist_ok=True)
 
-    # Load the concatenated table
-    df = pd.read_csv(concatenated_table, sep='\t')
-
     plt.figure(figsize=(12, 8))
     sns.boxplot(x='threshold', y='number_of_members', data=df)
 
@@ -138,16 +128,21 @@ def plot_number_of_members_boxplot(concatenated_table: str, output_dir: str, tre
 
 
 @time_it("Generating plots")
-def generate_plots(output_paths: Dict[str, str], tree_type: str) -> None:
+def generate_plots(output_paths: Dict[str, str], tree_type: str, thresholds: List[float] = DEFAULT_THRESHOLDS,
+                   df: Optional[pd.DataFrame] = None) -> None:
     """Generate and save all relevant plots.
 
     Args:
         output_paths (Dict[str, str]): Dictionary containing output paths for the various files.
         tree_type (str): The type of the tree being analyzed (e.g., 'rooted', 'unrooted', 'midpoint').
+        thresholds (List[float]): Crassvirales ratio thresholds (%) to plot.
+        df (Optional[pd.DataFrame]): Selected clades for all thresholds; read from the selection profile if None.
     """
-    concatenated_table = output_paths['biggest_non_intersecting_clades_all']
-
-    plot_bacterial_ratios_vs_threshold(concatenated_table, output_paths['output_dir'], tree_type)
-    plot_crassvirales_bacterial_viral_ratios_vs_threshold(concatenated_table, output_paths['output_dir'], tree_type)
-    plot_number_of_clades_vs_threshold(concatenated_table, output_paths['output_dir'], tree_type)
-    plot_number_of_members_boxplot(concatenated_table, output_paths['output_dir'], tree_type)
+    if df is None:
+        profile = load_selection_profile(output_paths['selection_profile'])
+        df = expand_selection_profile(profile, thresholds)
+
+    plot_bacterial_ratios_vs_threshold(df, output_paths['output_dir'], tree_type)
+    plot_crassvirales_bacterial_viral_ratios_vs_threshold(df, output_paths['output_dir'], tree_type)
+    plot_number_of_clades_vs_threshold(df, output_paths['output_dir'], tree_type)
+    plot_number_of_members_boxplot(df, output_paths['output_dir'], tree_type)
@@ -20,18 +20,19 @@ snakefile="/home/zo49sog/crassvirales/phylomes/tree_analysis/Snakefile"
 jobs=5000
 latency_wait="60"
 slurm_output_dir="${working_dir}/slurm_logs/logs"
-slurm_time="30:00"
 slurm_partition="short"
 slurm_nodes=1
 slurm_ntasks=1
-slurm_mem_gb=5
+# Memory (MB) and time (minutes) of jobs whose rule sets no resources; the cluster jobs get theirs from the
+# cluster index and the benchmarks of earlier runs
+default_resources="mem_mb=5000 runtime=30"
 
 # Change to the working directory
 cd ${working_dir}
 
 mkdir -p ${slurm_output_dir}
 
-snakemake --snakefile "${snakefile}" --jobs ${jobs} --cluster "sbatch --output=${slurm_output_dir}/%x_%j.out.txt --time=${slurm_time} --partition=${slurm_partition} --nodes=${slurm_nodes} --ntasks=${slurm_ntasks} --cpus-per-task={threads} --mem=${slurm_mem_gb}GB" --latency-wait ${latency_wait}
+snakemake --snakefile "${snakefile}" --jobs ${jobs} --default-resources ${default_resources} --cluster "sbatch --output=${slurm_output_dir}/%x_%j.out.txt --time={resources.runtime} --partition=${slurm_partition} --nodes=${slurm_nodes} --ntasks=${slurm_ntasks} --cpus-per-task={threads} --mem={resources.mem_mb}MB" --latency-wait ${latency_wait}
 
 # Run Snakemake with SLURM cluster submission
 #snakemake --snakefile "${snakefile}" --jobs ${jobs} --cluster "sbatch --output=${slurm_output_dir}/{rule}_%x_%j.out --time=${slurm_time} --partition=${slurm_partition} --nodes=${slurm_nodes} --ntasks=${slurm_ntasks} --cpus-per-task={threads} --mem={resources.mem_mb}MB" --latency-wait ${latency_wait}
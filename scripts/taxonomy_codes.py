@@ -0,0 +1,116 @@
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Leaf features copied from the annotation table, and the annotation columns they are read from
+TAXONOMY_FEATURES: Tuple[str, ...] = ('source', 'superkingdom', 'phylum', 'class_', 'order', 'family', 'subfamily',
+                                      'genus')
+ANNOTATION_COLUMNS: Tuple[str, ...] = ('source', 'superkingdom', 'phylum', 'class', 'order', 'family', 'subfamily',
+                                       'genus')
+
+# Code of a node without taxonomy (internal nodes, leaves of trees that were never annotated)
+MISSING = -1
+# Value given to every feature of a leaf that is not in the annotation table
+UNKNOWN = 'unknown'
+
+
+class TaxonomyVocabulary:
+    """Distinct values of each taxonomy feature, so that an annotation is stored as one integer code per feature.
+
+    ``values[j][code]`` is the value of feature ``TAXONOMY_FEATURES[j]`` with that code. Missing annotation
+    values (NaN) get a code of their own, like any other value.
+    """
+
+    def __init__(self, values: Optional[List[List[Any]]] = None) -> None:
+        self.values = values if values is not None else [[] for _ in TAXONOMY_FEATURES]
+
+    @classmethod
+    def factorize(cls, columns: Sequence[Sequence[Any]]) -> Tuple['TaxonomyVocabulary', np.ndarray]:
+        """Build a vocabulary from one sequence of values per feature and return it with the (rows x features) codes."""
+        n_rows = len(columns[0]) if columns else 0
+        codes = np.empty((n_rows, len(TAXONOMY_FEATURES)), dtype=np.int32)
+        values = []
+        for j, column in enumerate(columns):
+            column_codes, uniques = pd.factorize(pd.Series(column), use_na_sentinel=False)
+            codes[:, j] = column_codes
+            values.append(list(uniques))
+        return cls(values), codes
+
+    def find(self, feature: str, value: Any) -> Optional[int]:
+        """Return the code of a value, or None if no node has it."""
+        values = self.values[TAXONOMY_FEATURES.index(feature)]
+        return values.index(value) if value in values else None
+
+    def code(self, feature: str, value: Any) -> int:
+        """Return the code of a value, adding it to the vocabulary if needed."""
+        code = self.find(feature, value)
+        if code is None:
+            values = self.values[TAXONOMY_FEATURES.index(feature)]
+            values.append(value)
+            code = len(values) - 1
+        return code
+
+    def decode(self, codes: Sequence[int]) -> Optional[Tuple[Any, ...]]:
+        """Return the feature values of one row of codes, or None for a node without taxonomy."""
+        if codes[0] == MISSING:
+            return None
+        return tuple(values[code] for values, code in zip(self.values, codes))
+
+
+class AnnotationCodes:
+    """Annotation table held as integer taxonomy codes, looked up by protein_id."""
+
+    def __init__(self, protein_ids: pd.Index, codes: np.ndarray, vocabulary: TaxonomyVocabulary) -> None:
+        self.protein_ids = protein_ids
+        self.codes = codes
+        self.vocabulary = vocabulary
+
+    def __len__(self) -> int:
+        return len(self.protein_ids)
+
+    @classmethod
+    def from_dataframe(cls, annotations: pd.DataFrame) -> 'AnnotationCodes':
+        """Encode an annotation table with unique protein IDs."""
+        vocabulary, codes = TaxonomyVocabulary.factorize([annotations[column] for column in ANNOTATION_COLUMNS])
+        return cls(pd.Index(annotations['protein_id']), codes, vocabulary)
+
+    def build_index(self) -> None:
+        """Build the hash table of the protein IDs now rather than on the first lookup."""
+        self.protein_ids.get_indexer(self.protein_ids[:1])
+
+    def lookup(self, protein_ids: Sequence[str], partial: bool = False) -> np.ndarray:
+        """Return the codes of the given proteins.
+
+        By default proteins are matched exactly (like tree_utils.annotate_tree_id) and every feature of a
+        protein not in the table is set to 'unknown'. With ``partial``, a protein takes the first row whose
+        protein_id is a prefix of its name (like tree_utils.annotate_tree) and is left MISSING if none is.
+        """
+        if partial:
+            rows = prefix_match_rows(self.protein_ids, protein_ids)
+        else:
+            rows = self.protein_ids.get_indexer(protein_ids)
+        found = rows >= 0
+        codes = np.full((len(rows), len(TAXONOMY_FEATURES)), MISSING, dtype=np.int32)
+        codes[found] = self.codes[rows[found]]
+        if not partial and not found.all():
+            codes[~found] = [self.vocabulary.code(feature, UNKNOWN) for feature in TAXONOMY_FEATURES]
+        return codes
+
+
+def prefix_match_rows(keys: pd.Index, labels: Sequence[str]) -> np.ndarray:
+    """Return for each label the first position in ``keys`` holding a prefix of the label, or -1 if there is none.
+
+    Rather than testing every key with startswith, the (hashed) index is probed with every prefix of every
+    label, so the cost grows with the label lengths and not with the number of keys.
+    """
+    if len(labels) == 0:
+        return np.empty(0, dtype=np.intp)
+
+    prefixes = [label[:length] for label in labels for length in range(len(label) + 1)]
+    rows = keys.get_indexer(prefixes)
+    rows[rows < 0] = len(keys)
+    starts = np.cumsum([0] + [len(label) + 1 for label in labels[:-1]])
+    first_rows = np.minimum.reduceat(rows, starts)
+    first_rows[first_rows == len(keys)] = -1
+    return first_rows
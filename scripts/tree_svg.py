@@ -0,0 +1,208 @@
+import logging
+from typing import IO, Iterable, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from clade_analysis import DEFAULT_THRESHOLDS
+from colours import COLLAPSED_COLORS, TAXONOMY_BOX_COLORS, source_colors, superkingdom_colors, phylum_colors, \
+    crassvirales_color
+from compact_tree import CompactTree
+from taxonomy_codes import MISSING, TAXONOMY_FEATURES
+from tree_utils import summarize_compact_tree
+from utils import time_it
+
+# Sizes in pixels, matching those of the ete3 tree plot: box side and node name font, pixels per unit of branch
+# length, and height of a leaf row
+BOX = 20
+SCALE = 100
+ROW_HEIGHT = 24
+MARGIN = 20
+LABEL_FONT_SIZE = 15
+# Average glyph width per font size unit, to place the aligned columns without font metrics
+CHAR_WIDTH = 0.6
+
+
+def layout_coordinates(tree: CompactTree) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the x (distance from the root) and y (leaf row) coordinates of every node of a rectangular layout.
+
+    Leaves take consecutive rows in preorder and each internal node is drawn midway between its first and last
+    child, which follow it in preorder, so a single pass over the nodes in reverse preorder places them all.
+    """
+    is_leaf = tree.is_leaf
+    y = np.zeros(len(tree))
+    y[is_leaf] = np.arange(np.count_nonzero(is_leaf))
+    rows = y.tolist()
+    offsets = tree.child_offsets.tolist()
+    child_index = tree.child_index.tolist()
+    for node in np.flatnonzero(~is_leaf)[::-1].tolist():
+        rows[node] = (rows[child_index[offsets[node]]] + rows[child_index[offsets[node + 1] - 1]]) / 2
+    return tree.distances_to_root(), np.asarray(rows)
+
+
+def taxonomy_box_colors(tree: CompactTree) -> List[List[str]]:
+    """Return the box colour of each code of the taxonomy features drawn as boxes, derived once from colours."""
+    return [[colors.get(value, default) for value in tree.vocabulary.values[TAXONOMY_FEATURES.index(feature)]]
+            for feature, colors, default in TAXONOMY_BOX_COLORS]
+
+
+def text_width(text: str, font_size: float) -> float:
+    """Return the approximate width of a line of text."""
+    return len(text) * font_size * CHAR_WIDTH
+
+
+def collapsed_box_width(total_proteins: int) -> int:
+    """Return the width of a collapsed node's box, which grows with the order of magnitude of its size."""
+    return BOX * (1 + int(np.log10(max(total_proteins, 1))))
+
+
+def write_rect(f: IO[str], x: float, y: float, width: float, color: str, stroke: Optional[str] = None) -> None:
+    """Write a box of the given width, one row high and vertically centred on y."""
+    f.write(f'<rect x="{x:.1f}" y="{y - BOX / 2:.1f}" width="{width}" height="{BOX}" fill="{color}" '
+            f'stroke="{stroke or color}"/>\n')
+
+
+def write_text(f: IO[str], x: float, y: float, text: str, font_size: float = BOX, bold: bool = False) -> None:
+    """Write a line of text starting at x and vertically centred on y."""
+    weight = ' font-weight="bold"' if bold else ''
+    f.write(f'<text x="{x:.1f}" y="{y:.1f}" font-size="{font_size}" dominant-baseline="central"{weight}>'
+            f'{escape(text)}</text>\n')
+
+
+def legend_rows(collapsed: bool) -> List[Tuple[str, str]]:
+    """Return the rows of the legend, as (colour, label) with an empty colour for a section title."""
+    rows = [('', 'Legend')]
+    sections = [('Source', source_colors), ('Superkingdom', superkingdom_colors), ('Phylum', phylum_colors),
+                ('Order', {'Crassvirales': crassvirales_color, 'Other': 'gray'})]
+    if collapsed:
+        sections.append(('Collapsed', {'Selected clade': COLLAPSED_COLORS['clade'],
+                                       'Other proteins': COLLAPSED_COLORS['other']}))
+    for title, colors in sections:
+        rows.append(('', title))
+        rows.extend((color, label) for label, color in colors.items())
+    return rows
+
+
+@time_it("Saving tree SVG")
+def save_tree_svg(tree: CompactTree, output_path: str, thresholds: List[float] = DEFAULT_THRESHOLDS,
+                  clade_flags: Optional[np.ndarray] = None, title: Optional[str] = None) -> None:
+    """Draw the tree to ``{output_path}.svg`` without a GUI toolkit, element by element as they are computed.
+
+    Draws what the ete3 layouts of plot_tree do: the name of every node and the Crassvirales ratio and total
+    members of the clades, taxonomy boxes aligned to the right of the leaves followed by one box per threshold
+    (black where ``clade_flags``, a nodes x thresholds mask, is set), and the legend of add_legend. Nodes of a
+    summary tree (see tree_utils.summarize_compact_tree) with the collapsed feature are drawn as a box with their
+    counts, with the taxonomy boxes of the remaining leaves next to their names.
+    """
+    x, y = layout_coordinates(tree)
+    top = MARGIN + (ROW_HEIGHT if title else 0)
+    xs = (MARGIN + x * SCALE).tolist()
+    ys = (top + (y + 0.5) * ROW_HEIGHT).tolist()
+
+    is_leaf = tree.is_leaf.tolist()
+    names = tree.names
+    parent = tree.parent.tolist()
+    codes = tree.taxonomy.tolist()
+    box_colors = taxonomy_box_colors(tree)
+    box_features = [TAXONOMY_FEATURES.index(feature) for feature, _, _ in TAXONOMY_BOX_COLORS]
+    collapsed = tree.features.get('collapsed')
+    total_proteins = tree.features.get('total_proteins')
+    ratios = tree.features.get('ratio_crass_to_total')
+    flags = clade_flags.tolist() if clade_flags is not None else None
+
+    def leaf_label(node: int) -> str:
+        if total_proteins is None or ratios is None:
+            return names[node]
+        return (f"{names[node]}  Crassvirales ratio: {ratios[node] * 100:.2f}%  "
+                f"Total members: {total_proteins[node]}")
+
+    # Aligned boxes start right of the longest leaf label; summary trees draw their boxes next to the names
+    label_end = max((xs[node] + 4 + text_width(leaf_label(node) if collapsed is None else names[node], BOX)
+                     for node in range(len(tree)) if is_leaf[node]), default=MARGIN)
+    aligned_x = label_end + BOX
+    if collapsed is None:
+        boxes_end = aligned_x + BOX * (len(box_features) + len(thresholds) + 2)
+    else:
+        # Room for the widest box and counts of a collapsed node
+        boxes_end = label_end + BOX * 8 + text_width(" 0000000 proteins, Crassvirales ratio: 100.00%", LABEL_FONT_SIZE)
+    legend = legend_rows(collapsed is not None)
+    legend_x = boxes_end + 2 * MARGIN
+    width = legend_x + BOX + text_width('Other proteins' + ' ' * 10, BOX) + MARGIN
+    height = max(top + (max(y.max(initial=0), 0) + 1) * ROW_HEIGHT, MARGIN + len(legend) * ROW_HEIGHT) + MARGIN
+
+    svg_output_path = f"{output_path}.svg"
+    with open(svg_output_path, 'w') as f:
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height:.0f}" '
+                f'viewBox="0 0 {width:.0f} {height:.0f}" font-family="Verdana">\n'
+                f'<rect width="100%" height="100%" fill="white"/>\n')
+        if title:
+            write_text(f, MARGIN, MARGIN + ROW_HEIGHT / 2, title)
+
+        # All branches in a single path: the horizontal branch to each node and the vertical line over its children
+        f.write('<path fill="none" stroke="black" stroke-width="1" d="')
+        offsets = tree.child_offsets.tolist()
+        child_index = tree.child_index.tolist()
+        for node in range(len(tree)):
+            if parent[node] >= 0:
+                f.write(f'M{xs[parent[node]]:.1f} {ys[node]:.1f}H{xs[node]:.1f}')
+            if not is_leaf[node]:
+                f.write(f'M{xs[node]:.1f} {ys[child_index[offsets[node]]]:.1f}'
+                        f'V{ys[child_index[offsets[node + 1] - 1]]:.1f}')
+        f.write('"/>\n')
+
+        for node in range(len(tree)):
+            node_x, node_y = xs[node] + 4, ys[node]
+            kind = collapsed[node] if collapsed is not None else None
+            if kind is not None and total_proteins is not None and ratios is not None:
+                write_text(f, node_x, node_y, names[node])
+                box_x = node_x + text_width(names[node], BOX)
+                box_width = collapsed_box_width(total_proteins[node])
+                write_rect(f, box_x, node_y, box_width, COLLAPSED_COLORS[kind], stroke='black')
+                write_text(f, box_x + box_width, node_y, f" {total_proteins[node]} proteins, Crassvirales ratio: "
+                                                         f"{ratios[node] * 100:.2f}%", LABEL_FONT_SIZE)
+            elif is_leaf[node]:
+                if collapsed is None:
+                    write_text(f, node_x, node_y, leaf_label(node))
+                    box_x = aligned_x
+                else:
+                    write_text(f, node_x, node_y, names[node])
+                    box_x = node_x + text_width(names[node], BOX)
+                if codes[node][0] != MISSING:
+                    for colors, feature in zip(box_colors, box_features):
+                        write_rect(f, box_x, node_y, BOX, colors[codes[node][feature]])
+                        box_x += BOX
+                if collapsed is None:
+                    # A spacer, the clade boxes of the thresholds and another spacer, as in plot_tree.layout
+                    box_x += BOX
+                    for j in range(len(thresholds)):
+                        color = 'black' if flags is not None and flags[node][j] else 'white'
+                        write_rect(f, box_x, node_y, BOX, color)
+                        box_x += BOX
+            elif collapsed is None:
+                # Clade labels sit above the branch leading to the clade rather than among its descendants
+                label = names[node]
+                if total_proteins is not None and ratios is not None:
+                    label += (f"  Crassvirales ratio: {ratios[node] * 100:.2f}%  "
+                              f"Total members: {total_proteins[node]}")
+                label_x = xs[parent[node]] if parent[node] >= 0 else xs[node]
+                write_text(f, label_x + 2, node_y - LABEL_FONT_SIZE / 2 - 1, label, LABEL_FONT_SIZE)
+
+        for row, (color, label) in enumerate(legend):
+            legend_y = MARGIN + (row + 0.5) * ROW_HEIGHT
+            if color:
+                write_rect(f, legend_x, legend_y, BOX, color)
+                write_text(f, legend_x + BOX + 4, legend_y, label)
+            else:
+                write_text(f, legend_x, legend_y, label, BOX + (2 if row == 0 else 1), bold=True)
+        f.write('</svg>\n')
+    logging.info(f"Tree SVG saved to {svg_output_path}")
+
+
+@time_it("Saving summary tree SVG")
+def save_summary_tree_svg(tree: CompactTree, clade_roots: Iterable[int], output_path: str, threshold: float) -> None:
+    """Save an SVG of the tree with the largest non-intersecting clades at the threshold collapsed."""
+    summary = summarize_compact_tree(tree, clade_roots)
+    logging.info(f"Summary tree at {threshold}% has {len(summary.leaf_indices)} leaves instead of "
+                 f"{len(tree.leaf_indices)}")
+    save_tree_svg(summary, output_path,
+                  title=f"Largest non-intersecting clades at a Crassvirales ratio of {threshold}% collapsed")
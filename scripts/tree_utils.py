@@ -1,12 +1,24 @@
 import logging
 import os
-from typing import Dict, Any
+from typing import Any, Callable, Dict, Iterable, List
+from urllib.parse import unquote
 
+import numpy as np
 import pandas as pd
 from ete3 import Tree
 
+from compact_tree import CompactTree
+from taxonomy_codes import TAXONOMY_FEATURES, prefix_match_rows
 from utils import time_it
 
+# Computed features saved with the annotated tree for the deferred tree plot, and how to parse them back
+ANNOTATED_TREE_FEATURES: Dict[str, Callable[[str], Any]] = {
+    'total_proteins': int,
+    'ratio_crass_to_total': float,
+}
+# Characters that NHX would replace with '_' in feature values, and '%' itself, saved percent-encoded instead
+NHX_ESCAPES = {char: f'%{ord(char):02X}' for char in '%:;(),[]=\t\n\r'}
+
 
 def ensure_directory_exists(path: str) -> None:
     """Ensure the directory for the given path exists."""
@@ -32,16 +44,12 @@ def load_annotations(annotation_path: str) -> pd.DataFrame:
 def annotate_tree(tree: Tree, annotations: pd.DataFrame) -> None:
     """Annotate the tree with values from the annotation file, allowing for partial matches."""
     annotations = annotations.drop_duplicates(subset='protein_id')
-    annotation_dict = annotations.set_index('protein_id').to_dict('index')
-    updated_annotation_dict: Dict[str, Dict[str, Any]] = {}
-
-    for node in tree.traverse():
-        if node.is_leaf():
-            leaf_label = node.name
-            for key in annotation_dict.keys():
-                if leaf_label.startswith(key):
-                    updated_annotation_dict[leaf_label] = annotation_dict[key]
-                    break
+    leaf_labels = [node.name for node in tree.traverse() if node.is_leaf()]
+    rows = prefix_match_rows(pd.Index(annotations['protein_id']), leaf_labels)
+    matched = rows >= 0
+    updated_annotation_dict: Dict[str, Dict[str, Any]] = dict(zip(
+        [label for label, found in zip(leaf_labels, matched.tolist()) if found],
+        annotations.iloc[rows[matched]].to_dict('records')))
 
     for node in tree.traverse():
         if node.is_leaf():
@@ -104,11 +112,16 @@ def assign_unique_ids(tree: Tree) -> None:
 
 def root_tree_at_bacteria(tree: Tree) -> None:
     """Root the tree at the most distant node belonging to the 'Bacteria' superkingdom."""
-    max_distance = 0
+    # Distances from the root for all nodes in one preorder pass, instead of walking up from every leaf
+    distances = {tree: 0.0}
+    for node in tree.iter_descendants('preorder'):
+        distances[node] = distances[node.up] + node.dist
+
+    max_distance = 0.0
     root_node = None
     for node in tree.iter_leaves():
         if 'superkingdom' in node.features and node.superkingdom == 'Bacteria':
-            distance = node.get_distance(tree)
+            distance = distances[node]
             if distance > max_distance:
                 max_distance = distance
                 root_node = node
@@ -116,11 +129,100 @@ def root_tree_at_bacteria(tree: Tree) -> None:
         tree.set_outgroup(root_node)
 
 
+def root_compact_tree_at_bacteria(tree: CompactTree) -> CompactTree:
+    """Return the compact tree rooted at the most distant leaf belonging to the 'Bacteria' superkingdom."""
+    bacteria = np.flatnonzero(tree.is_leaf & tree.taxonomy_mask('superkingdom', 'Bacteria'))
+    if len(bacteria) == 0:
+        return tree
+    distances = tree.distances_to_root()[bacteria]
+    # argmax keeps the first of equally distant leaves, like the strict comparison in root_tree_at_bacteria
+    farthest = int(np.argmax(distances))
+    if distances[farthest] <= 0.0:
+        return tree
+    return tree.set_outgroup(int(bacteria[farthest]))
+
+
+def summarize_compact_tree(tree: CompactTree, clade_roots: Iterable[int]) -> CompactTree:
+    """Return the backbone of the tree above the given non-intersecting clades, each clade collapsed into a leaf.
+
+    Collapsed clades get the feature collapsed='clade', and every subtree hanging off the backbone that has
+    none of the clades is collapsed as well, with collapsed='other'; leaves off the backbone are kept as they
+    are. The summary has O(clades x depth) nodes, however many leaves the tree has. Its nodes keep the
+    total_proteins and ratio_crass_to_total features computed for the clade statistics, and its ``origin`` maps
+    them to the nodes of ``tree``.
+    """
+    is_clade = np.zeros(len(tree), dtype=bool)
+    is_clade[list(clade_roots)] = True
+    on_backbone = np.zeros(len(tree), dtype=bool)
+    for clade_root in np.flatnonzero(is_clade).tolist():
+        node = int(tree.parent[clade_root])
+        while node >= 0 and not on_backbone[node]:
+            on_backbone[node] = True
+            node = int(tree.parent[node])
+
+    # Kept nodes in preorder, with their child lists in summary numbering
+    kept: List[int] = []
+    children: List[List[int]] = []
+    stack = [(0, -1)]
+    while stack:
+        node, parent = stack.pop()
+        if parent >= 0:
+            children[parent].append(len(kept))
+        if on_backbone[node]:
+            stack.extend((child, len(kept)) for child in reversed(tree.children(node).tolist()))
+        kept.append(node)
+        children.append([])
+
+    summary = CompactTree.from_adjacency(0, children, tree.dist[kept], tree.support[kept],
+                                         [tree.names[node] for node in kept], tree.taxonomy[kept], tree.vocabulary)
+    summary.origin = np.asarray(kept, dtype=np.int32)
+    is_leaf = tree.is_leaf
+    summary.features['collapsed'] = ['clade' if is_clade[node] else
+                                     'other' if not (on_backbone[node] or is_leaf[node]) else None for node in kept]
+    for feature_name in ('total_proteins', 'ratio_crass_to_total'):
+        values = tree.features[feature_name]
+        summary.features[feature_name] = [values[node] for node in kept]
+    return summary
+
+
+@time_it(message="save annotated tree")
+def save_annotated_tree(tree: CompactTree, output_path: str) -> None:
+    """Save the tree with its taxonomy and the features the tree plot draws, as Newick with NHX comments.
+
+    Taxonomy values are percent-encoded where NHX would otherwise alter them (as in 'Pseudomonadota
+    (Proteobacteria)'), so that load_annotated_tree gets them back unchanged.
+    """
+    ete_tree = tree.to_ete()
+    for node in ete_tree.traverse():
+        for feature in TAXONOMY_FEATURES:
+            if hasattr(node, feature):
+                setattr(node, feature, ''.join(NHX_ESCAPES.get(char, char) for char in str(getattr(node, feature))))
+    ete_tree.write(outfile=output_path, features=[*TAXONOMY_FEATURES, *ANNOTATED_TREE_FEATURES], format=1,
+                   format_root_node=True, dist_formatter='%r')
+
+
+@time_it(message="load annotated tree")
+def load_annotated_tree(tree_path: str) -> CompactTree:
+    """Load a tree saved by save_annotated_tree as a compact tree with its taxonomy and features."""
+    tree = Tree(tree_path, format=1)
+    nodes = list(tree.traverse('preorder'))
+    for node in nodes:
+        for feature in TAXONOMY_FEATURES:
+            if hasattr(node, feature):
+                setattr(node, feature, unquote(getattr(node, feature)))
+    compact_tree = CompactTree.from_ete(tree)
+    for feature_name, parse in ANNOTATED_TREE_FEATURES.items():
+        compact_tree.features[feature_name] = [parse(getattr(nodes[node], feature_name))
+                                               for node in compact_tree.origin.tolist()]
+    return compact_tree
+
+
 def print_node_features(tree: Tree) -> None:
-    """Log features of all nodes in the tree."""
+    """Log features of all nodes in the tree at DEBUG level; the tree is not traversed at all when that is off."""
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
     for node in tree.traverse():
-        logging.debug(f"Node: {node.name}")
+        logging.debug("Node: %s", node.name)
         for feature_name in node.features:
-            feature_value = getattr(node, feature_name)
-            logging.debug(f"  {feature_name}: {feature_value}")
+            logging.debug("  %s: %s", feature_name, getattr(node, feature_name))
         logging.debug("-" * 40)  # Separator between nodes
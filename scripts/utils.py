@@ -1,17 +1,98 @@
 from functools import wraps
+import json
 import logging
-from time import perf_counter
-from typing import Callable, Any, Optional
+import os
+import resource
+import tracemalloc
+import uuid
+from datetime import datetime
+from time import perf_counter, process_time
+from typing import Callable, Any, Dict, List, Optional
+
+# File to which time_it appends a JSON record per timed call (None to only log the time), and the fields
+# (run, cluster, tree type, leaf count) added to every record
+_metrics_path: Optional[str] = None
+_metrics_context: Dict[str, Any] = {}
+# Peak traced memory so far of each timed call in progress, innermost last
+_traced_peaks: List[int] = []
+
+
+def start_metrics(path: Optional[str], trace_memory: bool = False, **context: Any) -> None:
+    """Make time_it append its records to ``path``, after those of earlier runs.
+
+    The records of this run get a new run_id and its start time, from which metrics_report picks the latest
+    run that did the work of each cluster. With ``trace_memory``, tracemalloc is started so that the records
+    include the peak memory allocated by Python during each call; this slows the run down.
+    """
+    global _metrics_path
+    _metrics_path = path
+    _metrics_context.clear()
+    _metrics_context.update(run_id=uuid.uuid4().hex, run_started=datetime.now().isoformat(), **context)
+    if path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def update_metrics_context(**context: Any) -> None:
+    """Set fields added to the records of the calls that end from now on."""
+    _metrics_context.update(context)
+
+
+def max_rss_mb() -> float:
+    """Return the peak resident set size of the process so far, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def start_traced_memory() -> Optional[int]:
+    """Start measuring the traced memory peak of a call, if tracemalloc is on; return the traced memory now."""
+    if not tracemalloc.is_tracing():
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    # Resetting the peak for this call must not lose the peak of the calls it is nested in
+    if _traced_peaks:
+        _traced_peaks[-1] = max(_traced_peaks[-1], peak)
+    _traced_peaks.append(current)
+    tracemalloc.reset_peak()
+    return current
+
+
+def stop_traced_memory(start: Optional[int]) -> Optional[int]:
+    """Return the traced memory peak of a call measured since start_traced_memory returned ``start``."""
+    if start is None or not _traced_peaks:
+        return None
+    peak = max(_traced_peaks.pop(), tracemalloc.get_traced_memory()[1])
+    if _traced_peaks:
+        _traced_peaks[-1] = max(_traced_peaks[-1], peak)
+    return peak
+
+
+def write_metrics(record: Dict[str, Any]) -> None:
+    """Append a record, with the current context, to the metrics file set by start_metrics."""
+    if _metrics_path is None:
+        return
+    with open(_metrics_path, 'a') as f:
+        f.write(json.dumps({**_metrics_context, **record}) + '\n')
 
 
 def time_it(message: Optional[str] = None) -> Callable[..., Any]:
-    """Decorator to measure the execution time of a function with an optional formatted message."""
+    """Decorator to measure the execution time of a function with an optional formatted message.
+
+    The time is logged, and once start_metrics has been called a record with the wall and CPU time and the
+    memory peaks of the call is written as well, with the function's name as stage.
+    """
 
     def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
         @wraps(func)
         def wrapper(*args, **kwargs) -> Any:
             start_time = perf_counter()
-            result = func(*args, **kwargs)
+            start_cpu_time = process_time()
+            start_max_rss = max_rss_mb()
+            start_traced = start_traced_memory()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                traced_peak = stop_traced_memory(start_traced)
             end_time = perf_counter()
             elapsed_time = end_time - start_time
 
@@ -36,6 +117,18 @@ def time_it(message: Optional[str] = None) -> Callable[..., Any]:
             # log_message = f"Execution time for {final_message}: {elapsed_time:.2f} seconds\t%(funcName)s"
             logging.info(log_message)
             # print(log_message)
+
+            end_max_rss = max_rss_mb()
+            write_metrics({
+                'stage': func.__name__,
+                'message': final_message,
+                'wall_time_s': round(elapsed_time, 4),
+                'cpu_time_s': round(process_time() - start_cpu_time, 4),
+                'max_rss_mb': round(end_max_rss, 1),
+                'max_rss_growth_mb': round(end_max_rss - start_max_rss, 1),
+                'traced_peak_mb': None if traced_peak is None or start_traced is None else round(
+                    (traced_peak - start_traced) / 2 ** 20, 1),
+            })
             return result
 
         return wrapper